@@ -0,0 +1,149 @@
+import os, sys
+import json
+import hashlib
+from numpy import arange, around, logspace, log10, sqrt, array, full, nan, isnan, minimum, where, \
+        clip, take_along_axis, errstate, savez, load
+
+import gmice
+
+cachedir = 'adist_cache' # computed alert distances by model parameters
+mags = around(arange(3.0, 8.55, 0.1), 1) # magnitude grid of the table
+mmis = arange(2.5, 9.0, 0.5) # MMI levels of the table
+rgrid = logspace(-3, log10(2000.), 4000) # distances (km) the GMPE is evaluated at
+
+def parametricGMPE(coef, m, r, vs30):
+    '''
+    log10 ground motion of the parametric GMPE for broadcastable arrays of magnitude,
+    distance (km) and Vs30 (m/s)
+    '''
+    h = 10.**(coef['h0'] + coef['h1'] * m)
+    return coef['a'] + coef['b'] * (m - 6.) + coef['c'] * (m - 6.)**2 + \
+            (coef['d'] + coef['e'] * (m - 6.)) * log10(sqrt(r**2 + h**2)) + \
+            coef['f'] * r + coef['g'] * log10(vs30 / 760.)
+
+# Parametric GMPE stand-in for the OpenQuake scripts, log10 PGA (cm/s/s) and PGV (cm/s):
+#     log10(Y) = a + b(M-6) + c(M-6)^2 + (d + e(M-6)) log10(sqrt(R^2 + h^2)) + f R + g log10(Vs30/760)
+#     h = 10^(h0 + h1 M)
+# GMPES entries give the function fn(coef, m, r, vs30) of log10 ground motion and its PGA and PGV
+# coefficients. Coefficients were fitted to moratalla_alert_distances.tbl with the moratalla GMICE at
+# Vs30 760 m/s (the Vs30 terms are not fitted): the alert distances are within 4% of the table at the
+# median and 10% at the 90th percentile. The fit is poor where a level is first reached, under 2 km:
+# distances there are off by up to a factor of 18, and 8 entries just above the onset magnitude
+# (e.g. M3.7 MMI 5.5, M4.1 MMI 6.0) are not reached at all and are written as -1.
+GMPES = {
+    'parametric': {'fn': parametricGMPE,
+                   'pga': {'a': 3.8794, 'b': 0.5941, 'c': -0.0234, 'd': -1.5293, 'e': 0.1199,
+                           'f': 0.0, 'g': -0.6, 'h0': 0.4902, 'h1': 0.0},
+                   'pgv': {'a': 2.8924, 'b': 0.4924, 'c': -0.0977, 'd': -1.0, 'e': -0.0911,
+                           'f': -0.0027, 'g': -0.84, 'h0': -1.5954, 'h1': 0.5019}},
+}
+
+def mmiGrid(gmpe, gmicename, vs30s):
+    '''
+    Median MMI on the Vs30 x magnitude x distance grid
+    Returns:
+        array (Vs30, magnitude, distance)
+    '''
+    m = mags[None, :, None]
+    r = rgrid[None, None, :]
+    v = array(vs30s, dtype=float)[:, None, None]
+    model = GMPES[gmpe]
+    return gmice.gm2mmiArray(model['fn'](model['pga'], m, r, v), model['fn'](model['pgv'], m, r, v), gmicename)
+
+def alertRadii(mmi):
+    '''
+    Invert the MMI grid for the largest distance each MMI level is reached at, interpolated in
+    log distance. MMI is made non-increasing with distance first.
+    Returns:
+        array (Vs30, magnitude, MMI level) of distances (km), NaN where the level is not reached
+    '''
+    mmi = minimum.accumulate(mmi, axis=2)
+    lr = log10(rgrid)
+    n = len(rgrid)
+    radii = full(mmi.shape[:2] + (len(mmis),), nan)
+    for k, level in enumerate(mmis):
+        # last grid distance the level is reached at, then interpolate to the next
+        i0 = (mmi >= level).sum(axis=2) - 1
+        i1 = minimum(i0 + 1, n - 1)
+        m0 = take_along_axis(mmi, clip(i0, 0, n - 1)[:, :, None], axis=2)[:, :, 0]
+        m1 = take_along_axis(mmi, i1[:, :, None], axis=2)[:, :, 0]
+        with errstate(divide='ignore', invalid='ignore'):
+            f = where(m0 > m1, (m0 - level) / (m0 - m1), 0.)
+        r = 10.**(lr[clip(i0, 0, n - 1)] + f * (lr[i1] - lr[clip(i0, 0, n - 1)]))
+        radii[:, :, k] = where(i0 >= 0, r, nan)
+    return radii
+
+def cacheKey(gmpe, gmicename, vs30s):
+    '''
+    Hash of everything the alert distances depend on
+    '''
+    model = GMPES[gmpe]
+    key = {'gmpe': {k: model[k] for k in model if k != 'fn'}, 'fn': model['fn'].__name__, 'gmice': gmice.getGMICE(gmicename), 'vs30s': [float(v) for v in vs30s],
+           'mags': mags.tolist(), 'mmis': mmis.tolist(), 'rgrid': [float(rgrid[0]), float(rgrid[-1]), len(rgrid)]}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+def alertDists(gmpe='parametric', gmicename='moratalla', vs30s=(760.,)):
+    '''
+    Alert distances for a GMPE and GMICE, from the cache if these model parameters have been run
+    Returns:
+        array (Vs30, magnitude, MMI level) of distances (km), NaN where the level is not reached
+    '''
+    fname = os.path.join(cachedir, f'adist_{cacheKey(gmpe, gmicename, vs30s)}.npz')
+    if os.path.isfile(fname):
+        return load(fname)['radii']
+    radii = alertRadii(mmiGrid(gmpe, gmicename, vs30s))
+    os.makedirs(cachedir, exist_ok=True)
+    savez(fname, radii=radii)
+    return radii
+
+def wrAlertDists(fname, radii):
+    '''
+    Write alert distances for one Vs30 in the alert distance table format (magnitude mmi distance),
+    with -1 for levels that are not reached
+    '''
+    with open(fname, 'w') as fout:
+        for j, mag in enumerate(mags):
+            for k, mmi in enumerate(mmis):
+                if isnan(radii[j, k]):
+                    fout.write(f'{mag:.1f} {mmi:.1f} -1\n')
+                else:
+                    fout.write(f'{mag:.1f} {mmi:.1f} {radii[j, k]:.3f}\n')
+    return
+
+def tableFile(gmicename, gmpe='parametric', vs30=None):
+    '''
+    Alert distance table written for a GMICE and GMPE, with the Vs30 if one of several was run
+    '''
+    name = f'{gmicename}_{gmpe}' if vs30 is None else f'{gmicename}_{gmpe}_vs30-{vs30:.0f}'
+    return gmice.alertDistFile(name)
+
+def gmiceTable(gmicename):
+    '''
+    Alert distance table for a GMICE name: <gmice>_alert_distances.tbl if there is one (moratalla
+    ships with the repository), otherwise the parametric GMPE table at Vs30 760 m/s, written if missing
+    '''
+    fname = gmice.alertDistFile(gmicename)
+    if os.path.isfile(fname):
+        return fname
+    fname = tableFile(gmicename)
+    if not os.path.isfile(fname):
+        wrAlertDists(fname, alertDists('parametric', gmicename, (760.,))[0])
+        print(f'Wrote {fname}')
+    return fname
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    gmicename = sys.argv[1] # GMICE name (gmice.GMICES)
+    vs30s = [float(v) for v in sys.argv[2].split(',')] if len(sys.argv) > 2 else [760.] # Vs30 (m/s), comma separated
+    gmpe = sys.argv[3] if len(sys.argv) > 3 else 'parametric' # GMPE name (GMPES)
+    ###
+    ### Input parameters ###
+    ###
+
+    radii = alertDists(gmpe, gmicename, vs30s)
+    for i, vs30 in enumerate(vs30s):
+        fname = tableFile(gmicename, gmpe, None if len(vs30s) == 1 else vs30)
+        wrAlertDists(fname, radii[i])
+        print(f'Wrote {fname}')
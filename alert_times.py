@@ -1,16 +1,20 @@
 import sys
 import os
 import math
-import obspy as ob
-from obspy import UTCDateTime
+import hashlib
 import xml.etree.ElementTree as ET 
 import geographiclib.geodesic as geo
-from numpy import interp, log10, array, flip
+from numpy import interp, log10, array, flip, arange, meshgrid, sqrt, clip, \
+        where, rint, full, nan, isnan, savez, allclose
 
-import eew_utils as utils
-import moratalla as gmice
+import event_model as em
+import catalogue
+import gmice
+
+bIncremental = True # continue from the alerts of an earlier run, evaluating only new FinDer solutions
 
 def initialiseFDSOL(evid=''):
+    from obspy import UTCDateTime
     fdsol = {}
     fdsol['evid'] = evid
     fdsol['mag_regr'] = -1.
@@ -41,6 +45,8 @@ def scxml2fdsol(xml):
         fault coordinates, uncertainty
     '''
 
+    from obspy import UTCDateTime
+
     def getElem(obj, name1, name2):
         if obj is None:
             return '-9'
@@ -145,7 +151,11 @@ def calcdistaz(lat1, lon1, lat2, lon2):
 def rdAlertDists(fname):
     '''
     Alert strategy: for a contour-based (simple) alert system, want mag + MMI -> distance
+    fname can also be a GMICE name, for the alert distance file of that GMICE (alert_dists.gmiceTable)
     '''
+    if fname in gmice.GMICES:
+        import alert_dists
+        fname = alert_dists.gmiceTable(fname)
     alerts = {}
     with open(fname, 'r') as fin:
         for l in fin:
@@ -168,6 +178,7 @@ def rdSites(fname):
     File with station triplets: name lat lon
     '''
     stns = {}
+    import obspy as ob
     metadata = ob.read_inventory(fname)
     for stn in metadata.get_contents()['stations']:
         stnname = stn.split()[0].split('.')[1]
@@ -179,7 +190,7 @@ def rdSites(fname):
 
 def rdAlerts(fname, author, mag_w, latency):
     '''
-    Create from xml FinDer solutions, EEW alerts in dictionary form:
+    Create from xml FinDer solutions (read through the catalogue, see catalogue.py), EEW alerts in dictionary form:
     tstr: timestring for the alert UTCDateTime
     clat: rupture centroid lat
     clon: rupture centroid lon
@@ -189,11 +200,19 @@ def rdAlerts(fname, author, mag_w, latency):
     zlon: rupture end 2 lon
     mag: magnitude
     '''
-    with open(fname, 'r') as fin:
-        txt = fin.read()
-    ret, fdsols, fdevent, lastt = scxml2fdsol(txt)
-    alerts = []
-    for fd in [f for f in fdsols if f['author'] == author]:
+    return rdAuthorAlerts(fname, [author], mag_w, latency)[author]
+
+def rdAuthorAlerts(fname, authors, mag_w, latency):
+    '''
+    rdAlerts for several FinDer pipeline authors from one read of the solutions
+    Returns:
+        dictionary by author of alert lists
+    '''
+    ret, fdsols, fdevent, lastt = catalogue.rdFDSols(fname)
+    alerts = {author: [] for author in authors}
+    for fd in fdsols:
+        if fd['author'] not in alerts:
+            continue
         if fd['mag'] < mag_w:
             print(f'Ignoring alert as mag below threshold {fd}')
             continue
@@ -207,9 +226,15 @@ def rdAlerts(fname, author, mag_w, latency):
                 'zlat': fd['fcoords'][-1][0],
                 'zlon': fd['fcoords'][-1][1],
                 'mag': fd['mag']}
-        alerts.append(alert)
+        alerts[fd['author']].append(alert)
     return alerts
 
+def alertFile(evid, mag_w, latency, author=None):
+    '''
+    Alert table file name, with the author when several FinDer pipeline authors are compared
+    '''
+    return os.path.join(evid, f'alert_times_{mag_w:.1f}_{latency:.0f}' + ('' if author is None else f'_{author}') + '.tbl')
+
 def computeNearestDist(slat, slon, elat1, elon1, elat2, elon2):
     '''
     Nearest distance from point to line using Herons formula semiperimeter
@@ -229,42 +254,273 @@ def computeNearestDist(slat, slon, elat1, elon1, elat2, elon2):
         cdist = area * 2. / flen
     return cdist
 
-def computeAlerts(ev, sites, alerts, adists):
+def nearestDistArray(slat, slon, elat1, elon1, elat2, elon2):
+    '''
+    Vectorised nearest distance (km) from points to a line, using a local equirectangular
+    projection about the line centre. Adequate for rasters and distances of a few hundred km.
+    elat/elon define the line endpoints
+    slat/slon are arrays of points of interest
+    '''
+    lat0 = (elat1 + elat2) / 2.
+    lon0 = (elon1 + elon2) / 2.
+    kmdeg = 111.195
+    coslat = math.cos(math.radians(lat0))
+    px = (slon - lon0) * coslat * kmdeg
+    py = (slat - lat0) * kmdeg
+    ax = (elon1 - lon0) * coslat * kmdeg
+    ay = (elat1 - lat0) * kmdeg
+    bx = (elon2 - lon0) * coslat * kmdeg
+    by = (elat2 - lat0) * kmdeg
+    l2 = (bx - ax)**2 + (by - ay)**2
+    if l2 == 0.:
+        return sqrt((px - ax)**2 + (py - ay)**2)
+    t = clip(((px - ax) * (bx - ax) + (py - ay) * (by - ay)) / l2, 0., 1.)
+    return sqrt((px - ax - t * (bx - ax))**2 + (py - ay - t * (by - ay))**2)
+
+def predMMIArray(dist, adist):
+    '''
+    Interpolate the alert distances for a magnitude (adists[mag]) to predicted MMI at distance(s)
+    '''
+    mmis = [m for m in adist if adist[m] is not None]
+    return interp(log10(where(dist > 0.001, dist, 0.001)),
+            flip(log10(array([adist[m] for m in mmis]))),
+            flip(array(mmis)))
+
+def renderRaster(alert, adists, step, pad, cache=None):
+    '''
+    Render a raster of distance to the FinDer line source (and predicted MMI) around the rupture.
+    Args:
+        alert: alert dictionary (rdAlerts)
+        adists: alert distances (rdAlertDists)
+        step: raster spacing in degrees
+        pad: distance in km around the rupture to cover, usually the largest alert distance
+        cache: previous raster, reused if the fault geometry is unchanged
+    Returns:
+        raster: dictionary with the grid origin, spacing, distance and predicted MMI arrays
+    '''
+    key = (alert['alat'], alert['alon'], alert['zlat'], alert['zlon'], step, pad)
+    if cache is not None and cache['key'] == key:
+        if cache['mag'] != alert['mag']:
+            cache['pred'] = predMMIArray(cache['dist'], adists[alert['mag']])
+            cache['mag'] = alert['mag']
+        return cache
+    kmdeg = 111.195
+    padlat = pad / kmdeg
+    padlon = pad / (kmdeg * max(math.cos(math.radians(max(abs(alert['alat']), abs(alert['zlat'])) + padlat)), 0.1))
+    lats = arange(min(alert['alat'], alert['zlat']) - padlat, max(alert['alat'], alert['zlat']) + padlat + step, step)
+    lons = arange(min(alert['alon'], alert['zlon']) - padlon, max(alert['alon'], alert['zlon']) + padlon + step, step)
+    glon, glat = meshgrid(lons, lats)
+    dist = nearestDistArray(glat, glon, alert['alat'], alert['alon'], alert['zlat'], alert['zlon'])
+    return {'key': key, 'mag': alert['mag'], 'lat': lats, 'lon': lons, 'step': step,
+            'dist': dist, 'pred': predMMIArray(dist, adists[alert['mag']])}
+
+def lookupRaster(raster, slats, slons):
+    '''
+    Look up distance and predicted MMI at sites from the nearest raster cell
+    Returns:
+        dist, pred: arrays for the sites, NaN outside the raster
+    '''
+    i = rint((slats - raster['lat'][0]) / raster['step']).astype(int)
+    j = rint((slons - raster['lon'][0]) / raster['step']).astype(int)
+    inside = (i >= 0) & (i < len(raster['lat'])) & (j >= 0) & (j < len(raster['lon']))
+    dist = full(slats.shape, nan)
+    pred = full(slats.shape, nan)
+    dist[inside] = raster['dist'][i[inside], j[inside]]
+    pred[inside] = raster['pred'][i[inside], j[inside]]
+    return dist, pred
+
+def faultDists(sites, alert, dcache):
+    '''
+    Nearest distance (km, computeNearestDist) of each site to the fault line of an alert, cached in
+    dcache by fault geometry so repeated geometries (across updates or authors) are computed once
+    '''
+    fault = (alert['alat'], alert['alon'], alert['zlat'], alert['zlon'])
+    if fault not in dcache:
+        dcache[fault] = {site: computeNearestDist(sites[site][0], sites[site][1], *fault) for site in sites}
+    return dcache[fault]
+
+def adistsKey(adists):
+    '''
+    Hash of the alert distances, saved with the alert arrays so that an incremental run only
+    continues from alerts computed with the same table
+    '''
+    items = sorted([(float(mag), sorted([(float(m), d) for m, d in adists[mag].items()])) for mag in adists])
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+def indexKey(sites, alerts, adists):
+    '''
+    Hash of the sites, FinDer solutions and alert distances an alert index (computeAlertIndex) is
+    built from, saved with the index so that a stale one is rebuilt
+    '''
+    items = [adistsKey(adists), sorted([(s, float(sites[s][0]), float(sites[s][1])) for s in sites]),
+             [(str(a['tstr']), a['mag'], a['alat'], a['alon'], a['zlat'], a['zlon']) for a in alerts]]
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+def rdPrevious(fname, times, key, sites):
+    '''
+    Alerts of an earlier run (the arrays saved alongside the table) to continue from: only if they
+    were computed with the same alert distances (adistsKey) and sites (names and locations) for the
+    first of these solution times
+    Returns:
+        salerts: alert table dictionary, None if there is nothing to continue from
+    '''
+    npz = fname.replace('.tbl', '.npz')
+    if not os.path.isfile(npz):
+        return None
+    arrays = em.rdModel(npz)
+    n = len(arrays['times'])
+    if 'adists' not in arrays or str(arrays['adists']) != key or n > len(times) or not allclose(arrays['times'], times[:n]):
+        return None
+    names = sorted(sites)
+    if [str(x) for x in arrays['names']] != names or \
+            not allclose(arrays['lat'], [sites[s][0] for s in names]) or \
+            not allclose(arrays['lon'], [sites[s][1] for s in names]):
+        return None
+    return em.alertArraysToDict(arrays)
+
+def computeAlerts(ev, sites, alerts, adists, raster=None, author=None, dcache=None):
     '''
     Compute alert times per site:
     Name {'location': [lat, lon], 'dist': closest distance to fault in km, 2.0: seconds after origin for alert at this MMI, 3.0: etc.}
+    If raster is given (grid spacing in degrees), distances and predicted MMIs are looked up from a
+    raster rendered once per FinDer solution (reused while the fault geometry is unchanged), and the
+    predicted MMI raster for the last solution is saved.
+    The alerts are also saved as arrays (event_model.fromAlertDict) alongside the table.
+    author: FinDer pipeline author for the file names (alertFile), None for a single author
+    dcache: site distances by fault geometry (faultDists), shared between authors
+    With bIncremental, the alerts of an earlier run for the first solutions (rdPrevious) are kept
+    and only the new solutions are evaluated: first alert times can only be added, never moved later.
     '''
     evid = ev.resource_id.id.split(os.path.sep)[-1]
+    fname = alertFile(evid, mag_w, latency, author)
+    if dcache is None:
+        dcache = {}
     origin_time = ev.preferred_origin().time
-    salerts = {}
-    salerts['times'] = [a['tstr'] - origin_time for a in alerts]
-    for site in sites:
-        salerts[site] = {}
-        salerts[site]['location'] = sites[site]
-        salerts[site]['pred'] = []
-        for alert in alerts:
-            dist = computeNearestDist(
-                    sites[site][0], sites[site][1], 
-                    alert['alat'], alert['alon'], 
-                    alert['zlat'], alert['zlon'])
-            salerts[site]['dist'] = dist
-            for mmi in adists[alert['mag']]:
-                if adists[alert['mag']][mmi] is None:
-                    continue
-                if mmi in salerts[site]:
-                    continue
-                if adists[alert['mag']][mmi] > dist:
-                    salerts[site][mmi] = alert['tstr'] - origin_time
-            # Interpolate adists to get predMMI for this mag, dist; save max to salerts[site]['max']
-            predmmi = interp(math.log10(dist), 
-                    flip(log10(array([adists[alert['mag']][m] for m in adists[alert['mag']]]))),
-                    flip(array([m for m in adists[alert['mag']]])))
-            salerts[site]['pred'].append(predmmi)
-    with open(os.path.join(evid, f'alert_times_{mag_w:.1f}_{latency:.0f}.tbl'), 'w') as fout:
+    times = [a['tstr'] - origin_time for a in alerts]
+    key = adistsKey(adists)
+    salerts = rdPrevious(fname, times, key, sites) if bIncremental else None
+    if salerts is None:
+        salerts = {}
+        start = 0
+    else:
+        start = len(salerts['times'])
+        print(f'Updating {fname}: {len(alerts) - start} new of {len(alerts)} solutions')
+    salerts['times'] = times
+    if raster is not None:
+        last = computeRasterAlerts(salerts, sites, alerts, adists, origin_time, raster, start)
+        if last is not None:
+            savez(fname.replace('alert_times_', 'pred_mmi_').replace('.tbl', '.npz'),
+                  lat=last['lat'], lon=last['lon'], pred=last['pred'])
+    else:
+        dists = [faultDists(sites, alert, dcache) for alert in alerts[start:]]
+        for site in sites:
+            if site not in salerts:
+                salerts[site] = {}
+                salerts[site]['location'] = sites[site]
+                salerts[site]['pred'] = []
+            for alert, adist in zip(alerts[start:], dists):
+                dist = adist[site]
+                salerts[site]['dist'] = dist
+                for mmi in adists[alert['mag']]:
+                    if adists[alert['mag']][mmi] is None:
+                        continue
+                    if mmi in salerts[site]:
+                        continue
+                    if adists[alert['mag']][mmi] > dist:
+                        salerts[site][mmi] = alert['tstr'] - origin_time
+                # Interpolate adists to get predMMI for this mag, dist; save max to salerts[site]['max']
+                salerts[site]['pred'].append(predMMIArray(dist, adists[alert['mag']]))
+    arrays = em.fromAlertDict(salerts)
+    arrays['adists'] = array(key)
+    with open(fname, 'w') as fout:
         for site in sorted(salerts):
             fout.write(f'{site} {salerts[site]}\n')
+    # after the table, so event_model.rdEvent sees the npz as current
+    em.wrModel(fname.replace('.tbl', '.npz'), arrays)
     return
 
+def computeRasterAlerts(salerts, sites, alerts, adists, origin_time, step, start=0):
+    '''
+    Raster form of the site loop in computeAlerts: the cost per FinDer solution is the raster
+    render (skipped if the fault is unchanged) plus an array lookup for all sites.
+    Solutions before start are already in salerts (an incremental update) and are not evaluated.
+    Returns:
+        raster: the raster for the last solution (None if there are no solutions)
+    '''
+    names = list(sites)
+    slats = array([sites[s][0] for s in names])
+    slons = array([sites[s][1] for s in names])
+    pad = max([d for mag in adists for d in adists[mag].values() if d is not None])
+    mmis = sorted(set([m for mag in adists for m in adists[mag]]))
+    first = {m: array([salerts[s].get(m, nan) if s in salerts else nan for s in names], dtype=float) for m in mmis}
+    preds = []
+    dist = None
+    raster = None
+    for alert in alerts[start:]:
+        raster = renderRaster(alert, adists, step, pad, raster)
+        dist, pred = lookupRaster(raster, slats, slons)
+        outside = isnan(dist)
+        if outside.any():
+            # Sites beyond the largest alert distance: cannot be alerted, predicted MMI is the table minimum
+            dist[outside] = nearestDistArray(slats[outside], slons[outside],
+                    alert['alat'], alert['alon'], alert['zlat'], alert['zlon'])
+            pred[outside] = predMMIArray(dist[outside], adists[alert['mag']])
+        preds.append(pred)
+        t = alert['tstr'] - origin_time
+        for mmi in adists[alert['mag']]:
+            if adists[alert['mag']][mmi] is None:
+                continue
+            first[mmi][isnan(first[mmi]) & (adists[alert['mag']][mmi] > dist)] = t
+    for i, site in enumerate(names):
+        prev = salerts.get(site, {})
+        salerts[site] = {}
+        salerts[site]['location'] = sites[site]
+        salerts[site]['pred'] = prev.get('pred', []) + [float(p[i]) for p in preds]
+        if dist is not None:
+            salerts[site]['dist'] = float(dist[i])
+        elif 'dist' in prev:
+            salerts[site]['dist'] = prev['dist']
+        for mmi in mmis:
+            if not isnan(first[mmi][i]):
+                salerts[site][mmi] = float(first[mmi][i])
+    return raster
+
+def computeAlertIndex(ev, sites, alerts, adists):
+    '''
+    Per-site index of the FinDer solutions, in time order and without a magnitude threshold, from
+    which first alert times for any mag_w can be found without rerunning (see sweep.py)
+    Returns:
+        index: dictionary of arrays: site names, lat, lon, solution times (s after origin, alerts
+        tstr) and magnitudes, site to fault distance (site, solution), alert MMIs and the alert
+        distance for each solution and MMI (NaN if there is none)
+    '''
+    origin_time = ev.preferred_origin().time
+    alerts = sorted(alerts, key=lambda a: a['tstr'])
+    names = sorted(sites)
+    mmis = sorted(set([m for mag in adists for m in adists[mag]]))
+    dist = full((len(names), len(alerts)), nan)
+    adist = full((len(alerts), len(mmis)), nan)
+    geom = None
+    for j, alert in enumerate(alerts):
+        fault = (alert['alat'], alert['alon'], alert['zlat'], alert['zlon'])
+        if fault == geom:
+            dist[:, j] = dist[:, j-1]
+        else:
+            for i, site in enumerate(names):
+                dist[i, j] = computeNearestDist(sites[site][0], sites[site][1], *fault)
+            geom = fault
+        for k, mmi in enumerate(mmis):
+            if adists[alert['mag']].get(mmi) is not None:
+                adist[j, k] = adists[alert['mag']][mmi]
+    return {'names': array(names),
+            'lat': array([sites[s][0] for s in names]),
+            'lon': array([sites[s][1] for s in names]),
+            'times': array([a['tstr'] - origin_time for a in alerts]),
+            'mags': array([a['mag'] for a in alerts]),
+            'dist': dist,
+            'mmis': array(mmis),
+            'adist': adist}
+
 def printFirstAlert(ev, alerts):
     '''
     Print first alert
@@ -282,13 +538,16 @@ if __name__ == '__main__':
     ###
     geonet_evid = sys.argv[1] # GeoNet event ID
     fd_evid = sys.argv[2] # FinDer event ID
-    author = sys.argv[3] # FinDer pipeline author
-    adistfile = sys.argv[4] # Alert distance file
+    authors = sys.argv[3].split(',') # FinDer pipeline author, or comma separated authors to compare
+    adistfile = sys.argv[4] # Alert distance file, or GMICE name
     mag_w = float(sys.argv[5]) # Alert magnitude threshold
     latency = float(sys.argv[6]) # Added latency for alerts (judgement)
+    raster = float(sys.argv[7]) if len(sys.argv) > 7 else None # Optional predicted MMI raster spacing (degrees)
     ###
     ### Input parameters ###
     ###
+    import obspy as ob
+    import eew_utils as utils
 
     alertfile = os.path.join(geonet_evid, f'{fd_evid}.xml')
     if not os.path.isfile(alertfile):
@@ -305,8 +564,11 @@ if __name__ == '__main__':
         ev.write(evfile, format='QUAKEML')
     ev = ob.read_events(evfile, format='QUAKEML')[0]
 
-    alerts = rdAlerts(alertfile, author, mag_w, latency)
+    alerts = rdAuthorAlerts(alertfile, authors, mag_w, latency)
     sites = rdSites(os.path.join(geonet_evid, f'{geonet_evid}_inventory.xml'))
-    #printFirstAlert(ev, alerts)
     adists = rdAlertDists(adistfile)
-    computeAlerts(ev, sites, alerts, adists)
+    # One read of the solutions, sites and alert distances, and one distance cache, for all authors
+    dcache = {}
+    for author in authors:
+        #printFirstAlert(ev, alerts[author])
+        computeAlerts(ev, sites, alerts[author], adists, raster, None if len(authors) == 1 else author, dcache)
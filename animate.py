@@ -0,0 +1,197 @@
+import os, sys
+import glob
+import time
+import shutil
+import subprocess
+from multiprocessing import Pool
+from numpy import array, full, nan, isnan, where, nanmin, nanmax
+
+import event_model as em
+import plots
+
+fps = 5 # frames per second of the assembled animation
+dpi = 100 # frame resolution
+bGIF = True # assemble the frames into an animated GIF
+bMP4 = True # and into an MP4 if ffmpeg is on the path
+# Station colours by state at each frame: neither, alerted only, observed only, alerted and observed
+STATES = ['none', 'alerted', 'observed', 'both']
+COLOURS = array([[1., 1., 1., 1.], [1., 0.65, 0., 1.], [1., 0., 0., 1.], [0.2, 0.8, 0.2, 1.]])
+
+def frameData(model, alerts, mmi_a):
+    '''
+    Arrays the animation frames are drawn from, one frame per FinDer solution
+    model: event model with the alerts joined (event_model.rdEvent)
+    alerts: alert list (alert_times.rdAlerts) the alert table was computed from
+    Returns:
+        dictionary of times, mags, fault (alat, alon, zlat, zlon) and epicentre (elat, elon) per frame,
+        and lat, lon, alert and observed exceedance times of mmi_a per station in the alert table
+    '''
+    stations = model['inalerts'].nonzero()[0]
+    levels = [float(m) for m in model['levels']]
+    amms = [float(m) for m in model['amms']]
+    return {'times': array(model['times'], dtype=float),
+            'mags': array([a['mag'] for a in alerts]),
+            'fault': array([[a['alat'], a['alon'], a['zlat'], a['zlon']] for a in alerts]).reshape(len(alerts), 4),
+            'epi': array([[a['elat'], a['elon']] for a in alerts]).reshape(len(alerts), 2),
+            'lat': model['lat'][stations],
+            'lon': model['lon'][stations],
+            'alert': model['alert'][stations, amms.index(mmi_a)] if mmi_a in amms else full(len(stations), nan),
+            'exc': model['exc'][stations, levels.index(mmi_a)]}
+
+def frameStates(data, k):
+    '''
+    State (index into STATES) of each station at frame k: alerted and/or observed mmi_a by the
+    solution time
+    '''
+    t = data['times'][k]
+    alerted = where(isnan(data['alert']), False, data['alert'] <= t)
+    observed = where(isnan(data['exc']), False, data['exc'] <= t)
+    return alerted * 1 + observed * 2
+
+def frameBounds(data, pad=0.3):
+    '''
+    Map extent covering the stations and all fault lines
+    '''
+    lats = list(data['lat']) + list(data['fault'][:, 0]) + list(data['fault'][:, 2])
+    lons = list(data['lon']) + list(data['fault'][:, 1]) + list(data['fault'][:, 3])
+    return [nanmin(lons) - pad, nanmax(lons) + pad, nanmin(lats) - pad, nanmax(lats) + pad]
+
+def setupFrame(evid, data, mmi_a, bounds):
+    '''
+    Draw the static part of the animation once (basemap, gridlines, legend) and create the artists
+    that change per frame as animated, so they are left out of the saved background
+    Returns:
+        fig, ax, background, artists
+    '''
+    plots.loadPlotting()
+    plt = plots.plt
+    plt.switch_backend('Agg')
+    fig, ax, proj, map_proj = plots.setBasemap(bounds=bounds)
+    ax.set_title(f'{evid} alerts for MMI {mmi_a}', fontsize=8)
+    for i, state in enumerate(STATES):
+        ax.scatter([], [], color=COLOURS[i], edgecolor='k', lw=0.5, s=15, label=state)
+    ax.legend(loc='lower right', fontsize=6)
+    artists = {'stations': ax.scatter(data['lon'], data['lat'], transform=proj, c=COLOURS[full(len(data['lat']), 0)],
+                                      edgecolor='k', lw=0.5, s=15, zorder=3, animated=True),
+               'fault': ax.plot([], [], transform=proj, c='k', lw=2, zorder=4, animated=True)[0],
+               'epi': ax.plot([], [], '*', transform=proj, c='yellow', mec='k', ms=10, zorder=4, animated=True)[0],
+               'text': ax.text(0.02, 0.98, '', transform=ax.transAxes, va='top', fontsize=8, zorder=5, animated=True)}
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    return fig, ax, background, artists
+
+def drawFrame(fig, ax, background, artists, data, k):
+    '''
+    Blit frame k: restore the static background and draw only the changing artists
+    Returns:
+        RGBA image array
+    '''
+    fig.canvas.restore_region(background)
+    artists['stations'].set_facecolor(COLOURS[frameStates(data, k)])
+    alat, alon, zlat, zlon = data['fault'][k]
+    artists['fault'].set_data([alon, zlon], [alat, zlat])
+    artists['epi'].set_data([data['epi'][k, 1]], [data['epi'][k, 0]])
+    artists['text'].set_text(f'{data["times"][k]:.1f} s  M{data["mags"][k]:.1f}  solution {k + 1}/{len(data["times"])}')
+    for a in artists.values():
+        ax.draw_artist(a)
+    fig.canvas.blit(fig.bbox)
+    return array(fig.canvas.buffer_rgba())
+
+def renderFrames(args):
+    '''
+    Render a range of frames to numbered PNG files, building the figure once
+    args: evid, data, mmi_a, bounds, output directory and frame indices (a tuple for Pool.map)
+    Returns:
+        list of frame file names
+    '''
+    from PIL import Image
+    evid, data, mmi_a, bounds, outdir, frames = args
+    fig, ax, background, artists = setupFrame(evid, data, mmi_a, bounds)
+    fnames = []
+    for k in frames:
+        fnames.append(os.path.join(outdir, f'frame_{k:04d}.png'))
+        Image.fromarray(drawFrame(fig, ax, background, artists, data, k)).save(fnames[-1])
+    plots.plt.close(fig)
+    return fnames
+
+def animate(evid, data, mmi_a, outdir, workers=1):
+    '''
+    Render all frames, in parallel over contiguous chunks of frames if workers > 1 (each worker
+    draws the static map once; the plotting stack is imported before the workers are forked).
+    Workers are limited to the number of CPUs. Frames left in outdir by an earlier run are removed
+    first, so they are not assembled with the new ones.
+    Returns:
+        list of frame file names in order
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    for f in glob.glob(os.path.join(outdir, 'frame_*.png')):
+        os.remove(f)
+    bounds = frameBounds(data)
+    frames = list(range(len(data['times'])))
+    workers = min(workers, os.cpu_count() or 1, len(frames))
+    plots.loadPlotting()
+    if workers <= 1:
+        return renderFrames((evid, data, mmi_a, bounds, outdir, frames))
+    n = -(-len(frames) // workers)
+    chunks = [(evid, data, mmi_a, bounds, outdir, frames[i:i + n]) for i in range(0, len(frames), n)]
+    with Pool(workers) as pool:
+        return [f for fnames in pool.map(renderFrames, chunks) for f in fnames]
+
+def wrAnimation(fnames, fname):
+    '''
+    Assemble the frames into an animated GIF (bGIF) and an MP4 (bMP4, if ffmpeg is available)
+    '''
+    if bGIF:
+        from PIL import Image
+        images = [Image.open(f) for f in fnames]
+        images[0].save(f'{fname}.gif', save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0)
+        print(f'Wrote {fname}.gif')
+    if bMP4 and shutil.which('ffmpeg') is not None:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+                        '-i', os.path.join(os.path.dirname(fnames[0]), 'frame_%04d.png'),
+                        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', f'{fname}.mp4'], check=True)
+        print(f'Wrote {fname}.mp4')
+    return
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    mmi_a = float(sys.argv[2]) # Alert MMI to animate
+    mag_w = float(sys.argv[3]) # Magnitude to issue warnings for
+    latency = float(sys.argv[4]) # Delivery latency
+    fd_evid = sys.argv[5] # FinDer event ID
+    author = sys.argv[6] if len(sys.argv) > 6 else 'scfinder' # FinDer pipeline author
+    workers = int(sys.argv[7]) if len(sys.argv) > 7 else 1 # Processes rendering frames
+    ###
+    ### Input parameters ###
+    ###
+    import alert_times as at
+
+    tstart = time.perf_counter()
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    afname = at.alertFile(evid, mag_w, latency, author)
+    if not os.path.isfile(afname):
+        afname = at.alertFile(evid, mag_w, latency)
+    for fname in [ofname, afname, os.path.join(evid, f'{fd_evid}.xml')]:
+        if not os.path.isfile(fname):
+            print(f'Cannot animate as file {fname} is missing')
+            exit()
+    model = em.rdEvent(evid, ofname, afname)
+    if mmi_a not in [float(m) for m in model['levels']]:
+        print(f'Cannot animate MMI {mmi_a}, choose from the observed levels {", ".join([str(float(m)) for m in model["levels"]])}')
+        exit()
+    alerts = at.rdAlerts(os.path.join(evid, f'{fd_evid}.xml'), author, mag_w, latency)
+    if len(alerts) != len(model['times']):
+        print(f'Alert table {afname} does not match the {author} solutions above M{mag_w}')
+        exit()
+    if len(alerts) == 0:
+        print('No solutions to animate')
+        exit()
+    data = frameData(model, alerts, mmi_a)
+    name = os.path.join(evid, f'{evid}_anim_{author}_mmi{mmi_a}_{mag_w:.1f}_{latency:.0f}')
+    fnames = animate(evid, data, mmi_a, name, workers)
+    print(f'Rendered {len(fnames)} frames to {name} in {time.perf_counter() - tstart:.2f}s')
+    wrAnimation(fnames, name)
@@ -0,0 +1,176 @@
+import os, sys
+import time
+import sqlite3
+
+dbfile = os.environ.get('FINDER_CATALOGUE', 'finder_catalogue.db') # SQLite catalogue of FinDer solutions
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    fd_evid TEXT PRIMARY KEY, evid TEXT, publicid TEXT, locstr TEXT, xmlfile TEXT, mtime REAL,
+    origin_ns INTEGER, lastt_ns INTEGER);
+CREATE TABLE IF NOT EXISTS solutions (
+    fd_evid TEXT, evid TEXT, seq INTEGER, author TEXT, version INTEGER, vtime_ns INTEGER,
+    origin_time_ns INTEGER, t REAL, mag REAL, mag_rup REAL, mag_regr REAL, elat REAL, elon REAL,
+    depth REAL, clat REAL, clon REAL, fstrike REAL, flen REAL, uncr REAL, tstep INTEGER,
+    alat REAL, alon REAL, zlat REAL, zlon REAL,
+    PRIMARY KEY (fd_evid, seq));
+CREATE INDEX IF NOT EXISTS solutions_author ON solutions (author, mag, t);
+CREATE INDEX IF NOT EXISTS solutions_evid ON solutions (evid, author, vtime_ns);
+CREATE TABLE IF NOT EXISTS outcomes (
+    evid TEXT, author TEXT, mag_w REAL, latency REAL, mmi_tw REAL, mmi_a REAL,
+    FP INTEGER, TPU INTEGER, TPT INTEGER, TPL INTEGER, FN INTEGER, TN INTEGER, wt_median REAL,
+    PRIMARY KEY (evid, author, mag_w, latency, mmi_tw, mmi_a));
+'''
+# fdsol keys stored as solution columns (fcoords are stored as the rupture ends alat/alon, zlat/zlon,
+# the middle point is the centroid)
+FDSOL_COLUMNS = ['author', 'version', 'mag', 'mag_rup', 'mag_regr', 'elat', 'elon', 'depth', 'clat', 'clon',
+                 'fstrike', 'flen', 'uncr', 'tstep']
+
+def connect(fname=None):
+    '''
+    Open (creating if needed) the catalogue database
+    '''
+    conn = sqlite3.connect(dbfile if fname is None else fname)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+def evidFromXML(fname):
+    '''
+    GeoNet and FinDer event IDs from the FinDer dump path <evid>/<fd_evid>.xml
+    '''
+    return os.path.basename(os.path.dirname(os.path.abspath(fname))), os.path.splitext(os.path.basename(fname))[0]
+
+def originTime(evid, root):
+    '''
+    GeoNet origin time (ns) from <evid>/<evid>.xml, None if there is no event file
+    '''
+    evfile = os.path.join(root, f'{evid}.xml')
+    if not os.path.isfile(evfile):
+        return None
+    from obspy import read_events
+    return read_events(evfile, format='QUAKEML')[0].preferred_origin().time.ns
+
+def ingestXML(conn, fname):
+    '''
+    Parse a FinDer SCML dump (alert_times.scxml2fdsol) into the catalogue, replacing any earlier
+    ingest of the same FinDer event. Skipped if the file is unchanged since it was ingested, unless
+    it was ingested without an origin time and the event file (<evid>.xml) has arrived since.
+    Returns:
+        True if the file was parsed
+    '''
+    import alert_times as at
+    evid, fd_evid = evidFromXML(fname)
+    mtime = os.path.getmtime(fname)
+    row = conn.execute('SELECT mtime, origin_ns FROM events WHERE fd_evid = ?', (fd_evid,)).fetchone()
+    if row is not None and row['mtime'] == mtime and \
+            (row['origin_ns'] is not None or not os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(fname)), f'{evid}.xml'))):
+        return False
+    with open(fname, 'r') as fin:
+        txt = fin.read()
+    ret, fdsols, fdevent, lastt = at.scxml2fdsol(txt)
+    origin_ns = originTime(evid, os.path.dirname(os.path.abspath(fname)))
+    rows = []
+    for seq, fd in enumerate(fdsols):
+        row = {k: fd.get(k) for k in FDSOL_COLUMNS}
+        row.update({'fd_evid': fd_evid, 'evid': evid, 'seq': seq, 'vtime_ns': fd['vtime'].ns,
+                    'origin_time_ns': fd['origin_time'].ns,
+                    't': None if origin_ns is None else (fd['vtime'].ns - origin_ns) / 1e9})
+        if 'fcoords' in fd:
+            row.update({'alat': fd['fcoords'][0][0], 'alon': fd['fcoords'][0][1],
+                        'zlat': fd['fcoords'][-1][0], 'zlon': fd['fcoords'][-1][1]})
+        rows.append(row)
+    with conn:
+        conn.execute('DELETE FROM solutions WHERE fd_evid = ?', (fd_evid,))
+        conn.execute('DELETE FROM events WHERE fd_evid = ?', (fd_evid,))
+        conn.execute('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (fd_evid, evid, fdevent.get('evid'), fdevent.get('locstr'), os.path.abspath(fname), mtime,
+                      origin_ns, lastt.ns if ret else None))
+        for row in rows:
+            conn.execute(f'INSERT INTO solutions ({", ".join(row)}) VALUES ({", ".join(["?"] * len(row))})',
+                         list(row.values()))
+    return True
+
+def ingestDir(conn, root='.'):
+    '''
+    Ingest the FinDer dumps of all event directories under root: xml files in <evid>/ other than
+    the event (<evid>.xml) and inventory (<evid>_inventory.xml)
+    '''
+    n = 0
+    for evid in sorted(os.listdir(root)):
+        evdir = os.path.join(root, evid)
+        if not os.path.isdir(evdir):
+            continue
+        for f in sorted(os.listdir(evdir)):
+            if not f.endswith('.xml') or f in [f'{evid}.xml', f'{evid}_inventory.xml']:
+                continue
+            if ingestXML(conn, os.path.join(evdir, f)):
+                n += 1
+    return n
+
+def rdFDSols(fname, conn=None):
+    '''
+    Catalogue form of alert_times.scxml2fdsol for a FinDer dump: the file is ingested on first use
+    (or if it has changed) and the solutions are then read from the catalogue, in dump order
+    Returns:
+        ret, fdsols, fdevent, lastt: as scxml2fdsol
+    '''
+    from obspy import UTCDateTime
+    if conn is None:
+        conn = connect()
+    ingestXML(conn, fname)
+    evid, fd_evid = evidFromXML(fname)
+    event = conn.execute('SELECT * FROM events WHERE fd_evid = ?', (fd_evid,)).fetchone()
+    if event['lastt_ns'] is None:
+        return False, [], {}, 0.
+    fdsols = []
+    for row in conn.execute('SELECT * FROM solutions WHERE fd_evid = ? ORDER BY seq', (fd_evid,)):
+        fd = {'evid': event['publicid']}
+        for k in FDSOL_COLUMNS:
+            if row[k] is not None:
+                fd[k] = row[k]
+        fd['vtime'] = UTCDateTime(ns=row['vtime_ns'])
+        fd['origin_time'] = UTCDateTime(ns=row['origin_time_ns'])
+        if row['alat'] is not None:
+            fd['fcoords'] = [[row['alat'], row['alon']], [row['clat'], row['clon']], [row['zlat'], row['zlon']]]
+        fdsols.append(fd)
+    return True, fdsols, {'evid': event['publicid'], 'locstr': event['locstr']}, UTCDateTime(ns=event['lastt_ns'])
+
+def wrOutcome(evid, author, mag_w, latency, mmi_tw, counts, wt_median, conn=None):
+    '''
+    Record the category counts (dictionary by alert MMI of dictionaries by category) and median
+    TPT warning time (dictionary by alert MMI) of a run
+    '''
+    if conn is None:
+        conn = connect()
+    with conn:
+        for mmi_a in counts:
+            conn.execute('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [evid, author, mag_w, latency, mmi_tw, mmi_a] +
+                         [counts[mmi_a][c] for c in ['FP', 'TPU', 'TPT', 'TPL', 'FN', 'TN']] + [wt_median.get(mmi_a)])
+    return
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    command = sys.argv[1] # ingest [root] or query "SQL"
+    arg = sys.argv[2] if len(sys.argv) > 2 else None # root directory of the event directories, or SQL query
+    ###
+    ### Input parameters ###
+    ###
+
+    conn = connect()
+    tstart = time.perf_counter()
+    if command == 'ingest':
+        n = ingestDir(conn, '.' if arg is None else arg)
+        print(f'Ingested {n} FinDer dumps into {dbfile} in {time.perf_counter() - tstart:.2f}s')
+    elif command == 'query':
+        rows = conn.execute(arg).fetchall()
+        if len(rows) > 0:
+            print(' '.join(rows[0].keys()))
+        for row in rows:
+            print(' '.join([str(x) for x in row]))
+        print(f'{len(rows)} rows in {(time.perf_counter() - tstart)*1000.:.1f} ms')
+    else:
+        print(f'Unknown command {command}, use ingest or query')
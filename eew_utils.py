@@ -1,8 +1,25 @@
 import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from obspy import UTCDateTime, Stream, read
 from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.header import FDSNNoDataException
 
-def getClient():
-    return Client("GEONET")
+nthreads = 8 # concurrent waveform requests
+batchsize = 20 # channel groups per bulk waveform request
+retries = 3 # retries for a failed waveform request
+backoff = 2. # seconds before the first retry, doubled for each further retry
+sdsroot = os.environ.get('FINDER_SDS', 'sds') # shared waveform archive (SeisComP Data Structure)
+
+def getClient(url="GEONET"):
+    '''
+    FDSN client for a known provider key (default GeoNet) or a base URL, e.g. a local stand-in
+    server (fdsn_standin.py) which does not publish service descriptions
+    '''
+    if url.startswith('http'):
+        return Client(url, _discover_services=False)
+    return Client(url)
 
 def getEvent(client, evid, debug=False):
     '''
@@ -40,10 +57,59 @@ def downloadInv(client, ev):
     inventory.write(foutxml, format='STATIONXML')
     return foutxml
 
+def fetchBulk(client, bulk):
+    '''
+    Request a batch of waveforms with a single bulk request, retrying with exponential backoff
+    Args:
+        client: obspy FDSN Client
+        bulk: list of (network, station, location, channel, starttime, endtime)
+    Return:
+        st: obspy Stream (empty if there is no data), or None if all attempts failed
+    '''
+    wait = backoff
+    for attempt in range(retries + 1):
+        try:
+            return client.get_waveforms_bulk(bulk)
+        except FDSNNoDataException:
+            return Stream()
+        except Exception as e:
+            if attempt == retries:
+                print(f'Failed waveform request for {len(bulk)} channels after {retries} retries: {e}')
+                return None
+            time.sleep(wait)
+            wait *= 2.
+    return None
+
+def downloadBulk(client, bulk, callback):
+    '''
+    Download waveforms in batches of bulk requests over a bounded thread pool
+    Args:
+        client: obspy FDSN Client
+        bulk: list of (network, station, location, channel, starttime, endtime)
+        callback: function(batch, st) called in the calling thread as each batch completes,
+            st is empty if no data were returned and None if the request failed
+    '''
+    batches = [bulk[i:i+batchsize] for i in range(0, len(bulk), batchsize)]
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = {pool.submit(fetchBulk, client, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            callback(futures[future], future.result())
+    return
+
+def wfPending(evid):
+    '''
+    Marker next to <evid>_ms of a waveform download that has not completed (interrupted, or with
+    failed requests), so that the next run resumes it
+    '''
+    return os.path.join(evid, f'{evid}_ms.pending')
+
 def downloadWF(client, inventory, ev):
     '''
     Using an event id and region FDSN client, download metadata (inventory)
     and waveforms (one miniseed per channel)
+    Channels already downloaded are skipped, and each file is written complete (via a temporary
+    file) so an interrupted download can be resumed. The wfPending marker is kept until all
+    requests have succeeded.
     Args:
         client: obspy FDSN Client
         ev: obspy Event object
@@ -61,6 +127,12 @@ def downloadWF(client, inventory, ev):
     msdir = os.path.join(evid, '_'.join([evid, 'ms']))
     if not os.path.isdir(msdir):
         os.mkdir(msdir)
+    open(wfPending(evid), 'w').close()
+    # partial files of an interrupted run are requested again
+    for f in os.listdir(msdir):
+        if f.endswith('.part'):
+            os.remove(os.path.join(msdir, f))
+    bulk = []
     for inst in set([x[:-1] for x in inventory.get_contents()['channels']]):
         fname = '%s_%s.ms' % (evid, inst)
         stfname = os.path.join(msdir, fname)
@@ -72,13 +144,154 @@ def downloadWF(client, inventory, ev):
             continue
         if s[3][1] not in ['H', 'N']: # BB or SM
             continue
-        try:
-            st = client.get_waveforms(s[0], s[1], s[2], '%s?'%s[3], t1, t2)
-        except:
-            print('No data returned for %s'%inst)
-            continue
-        stlist.append(stfname)
-        st.write(stfname, format='MSEED')
+        bulk.append((s[0], s[1], s[2], '%s?'%s[3], t1, t2))
+
+    failed = []
+    def writeBatch(batch, st):
+        if st is None:
+            failed.extend(batch)
+            return
+        for b in batch:
+            inst = '.'.join(b[:3] + (b[3][:-1],))
+            stinst = st.select(network=b[0], station=b[1], location=b[2], channel=b[3])
+            if len(stinst) == 0:
+                print('No data returned for %s'%inst)
+                continue
+            stfname = os.path.join(msdir, '%s_%s.ms' % (evid, inst))
+            stinst.write(stfname + '.part', format='MSEED')
+            os.replace(stfname + '.part', stfname)
+            stlist.append(stfname)
+
+    downloadBulk(client, bulk, writeBatch)
+    if len(failed) == 0:
+        os.remove(wfPending(evid))
+    else:
+        print(f'{len(failed)} channels failed to download, rerun to resume')
     if len(stlist) == 0:
         return None
     return stlist
+
+def rdSDSIndex(root=sdsroot):
+    '''
+    Read the index of time ranges held in the SDS archive
+    Return:
+        index: dictionary keyed by channel id (NET.STA.LOC.CHA) of lists of [start, end]
+        timestamps, sorted and non-overlapping
+    '''
+    fname = os.path.join(root, 'index.json')
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname, 'r') as fin:
+        return json.load(fin)
+
+def wrSDSIndex(index, root=sdsroot):
+    '''
+    Write the SDS archive index (via a temporary file, so it is never left part written)
+    '''
+    fname = os.path.join(root, 'index.json')
+    with open(fname + '.part', 'w') as fout:
+        json.dump(index, fout)
+    os.replace(fname + '.part', fname)
+    return
+
+def addInterval(intervals, t1, t2):
+    '''
+    Add [t1, t2] to a sorted list of non-overlapping intervals, merging where they touch
+    '''
+    merged = []
+    for i in sorted(intervals + [[t1, t2]]):
+        if len(merged) > 0 and i[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], i[1])
+        else:
+            merged.append(list(i))
+    return merged
+
+def missingIntervals(intervals, t1, t2):
+    '''
+    Parts of [t1, t2] not covered by a sorted list of non-overlapping intervals
+    '''
+    gaps = []
+    for i in intervals:
+        if i[1] <= t1:
+            continue
+        if i[0] >= t2:
+            break
+        if i[0] > t1:
+            gaps.append([t1, i[0]])
+        t1 = max(t1, i[1])
+    if t1 < t2:
+        gaps.append([t1, t2])
+    return gaps
+
+def sdsPath(root, tr, day):
+    '''
+    SDS file name for a trace and day: YEAR/NET/STA/CHAN.TYPE/NET.STA.LOC.CHAN.TYPE.YEAR.DAY
+    '''
+    s = tr.stats
+    return os.path.join(root, f'{day.year}', s.network, s.station, f'{s.channel}.D',
+                        f'{s.network}.{s.station}.{s.location}.{s.channel}.D.{day.year}.{day.julday:03d}')
+
+def writeSDS(st, root=sdsroot):
+    '''
+    Write a stream into the SDS archive, split into day files and merged with existing data
+    '''
+    for tr in st:
+        day = UTCDateTime(tr.stats.starttime.date)
+        while day <= tr.stats.endtime:
+            trday = tr.slice(day, day + 86400. - tr.stats.delta)
+            day += 86400.
+            if trday.stats.npts == 0:
+                continue
+            fname = sdsPath(root, trday, trday.stats.starttime)
+            if os.path.isfile(fname):
+                stday = read(fname) + Stream([trday])
+                stday.merge(method=1)
+                stday = stday.split()
+            else:
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                stday = Stream([trday])
+            stday.write(fname + '.part', format='MSEED')
+            os.replace(fname + '.part', fname)
+    return
+
+def downloadSDS(client, inventory, ev, root=sdsroot):
+    '''
+    Make sure the shared SDS archive holds the event waveforms, downloading only the parts
+    of the event window not already in the archive index (e.g. from an earlier event in a sequence)
+    Args:
+        client: obspy FDSN Client
+        inventory: obspy inventory
+        ev: obspy Event object
+        root: SDS archive directory
+    Return:
+        index: the updated archive index
+    '''
+    origt = ev.preferred_origin().time
+    t1 = (origt - 120).timestamp
+    t2 = (origt + 300).timestamp
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    index = rdSDSIndex(root)
+    bulk = []
+    for chan in sorted(set(inventory.get_contents()['channels'])):
+        s = chan.split('.')
+        if s[3][0] not in ['H']: # high-rate
+            continue
+        if s[3][1] not in ['H', 'N']: # BB or SM
+            continue
+        for gap in missingIntervals(index.get(chan, []), t1, t2):
+            bulk.append((s[0], s[1], s[2], s[3], UTCDateTime(gap[0]), UTCDateTime(gap[1])))
+
+    def writeBatch(batch, st):
+        if st is None:
+            return
+        writeSDS(st, root)
+        # Requests answered without data are also recorded, so they are not repeated
+        for b in batch:
+            chan = '.'.join(b[:4])
+            index[chan] = addInterval(index.get(chan, []), b[4].timestamp, b[5].timestamp)
+        wrSDSIndex(index, root)
+
+    print(f'Requesting {len(bulk)} missing channel windows for the SDS archive')
+    downloadBulk(client, bulk, writeBatch)
+    return index
@@ -0,0 +1,143 @@
+import os, sys
+from numpy import array, nan, isnan, inf, where, log, floor, clip, zeros, full, float32, \
+        minimum, arange, nanpercentile, percentile, errstate
+from numpy.random import default_rng
+
+import plots
+import sweep
+
+sigma_gmice = 0.7 # GMICE standard deviation (MMI units), applied per station
+sigma_adist = 0.5 # alert distance standard deviation (natural log units), applied per event
+nsamples = 1000
+chunk = 100 # samples evaluated together, bounds memory at chunk x stations x alert MMIs x solutions
+
+def obsLevelArrays(obs, stns):
+    '''
+    Exceedance times (station, MMI level) with NaN replaced by the time of the highest level
+    exceeded, and maximum observed MMI, for interpolating exceedance times between levels
+    '''
+    levels = sorted([m for m in obs[stns[0]] if m not in ['location', 'max']])
+    etimes = array([[nan if obs[s][m] is None else obs[s][m] for m in levels] for s in stns])
+    for j in range(1, len(levels)):
+        etimes[:, j] = where(isnan(etimes[:, j]), etimes[:, j-1], etimes[:, j])
+    mmimax = array([obs[s]['max'] for s in stns])
+    return array(levels), etimes, mmimax
+
+def perturbedObsTimes(levels, etimes, mmimax, mmi, eps):
+    '''
+    Observed time of mmi when the GMICE is shifted by eps (sample, station): a station exceeds mmi
+    if its maximum MMI plus eps does, at the (interpolated) time it exceeded mmi - eps
+    Returns:
+        array (sample, station) of times, NaN if not exceeded
+    '''
+    dl = levels[1] - levels[0]
+    f = clip((mmi - eps - levels[0]) / dl, 0., len(levels) - 1.)
+    i0 = floor(f).astype(int)
+    i1 = minimum(i0 + 1, len(levels) - 1)
+    cols = arange(etimes.shape[0])[None, :]
+    t0 = etimes[cols, i0]
+    t1 = etimes[cols, i1]
+    t = t0 + (f - i0) * (t1 - t0)
+    return where(mmimax[None, :] + eps > mmi, t, nan)
+
+def logDistRatios(index, mag_w, mmis):
+    '''
+    Running minimum over solutions of log(site distance / alert distance), for the alert MMIs
+    and solutions above mag_w. A site is alerted for mmi at the first solution where this drops
+    below the log alert distance perturbation.
+    Returns:
+        array (site, MMI, solution)
+    '''
+    k = [list(index['mmis']).index(m) for m in mmis]
+    adist = index['adist'][:, k] # solution, MMI
+    with errstate(divide='ignore', invalid='ignore'):
+        r = log(index['dist'][:, :, None] / adist[None, :, :])
+    r = where(isnan(r) | (index['mags'][None, :, None] < mag_w), inf, r)
+    return minimum.accumulate(r, axis=1).transpose(0, 2, 1)
+
+def ensemble(index, obs, mmi_tw, mag_w, latency=0., seed=None):
+    '''
+    Monte-Carlo ensemble over GMICE and alert distance uncertainty, for all stations, alert MMIs,
+    solutions and samples as batched arrays (chunk samples at a time)
+    Returns:
+        stns, mmis: stations and alert MMIs
+        prob: array (station, MMI, category) of category probabilities
+        wt: array (sample, station, MMI) of TPT warning times (NaN if not TPT)
+        counts: array (sample, MMI, category) of station counts
+    '''
+    rng = default_rng(seed)
+    names = {s: i for i, s in enumerate(index['names'])}
+    stns = [s for s in obs if s in names]
+    ind = array([names[s] for s in stns], dtype=int)
+    levels, etimes, mmimax = obsLevelArrays(obs, stns)
+    mmis = [float(m) for m in index['mmis'] if float(m) in levels]
+    rmin = logDistRatios(index, mag_w, mmis)[ind] # station, MMI, solution
+    ncat = len(plots.CATEGORIES)
+    prob = zeros((len(stns), len(mmis), ncat))
+    wt = full((nsamples, len(stns), len(mmis)), nan, dtype=float32)
+    counts = zeros((nsamples, len(mmis), ncat), dtype=int)
+    tpt = plots.CATEGORIES.index('TPT')
+    for k0 in range(0, nsamples, chunk):
+        nk = min(chunk, nsamples - k0)
+        eps = rng.normal(0., sigma_gmice, (nk, len(stns)))
+        eta = rng.normal(0., sigma_adist, nk)
+        obs_tw = perturbedObsTimes(levels, etimes, mmimax, mmi_tw, eps)
+        for j, mmi_a in enumerate(mmis):
+            obs_a = perturbedObsTimes(levels, etimes, mmimax, mmi_a, eps)
+            first = (rmin[None, :, j, :] >= eta[:, None, None]).sum(axis=2) # sample, station
+            alerted = first < rmin.shape[2]
+            alert_a = where(alerted, index['times'][minimum(first, rmin.shape[2] - 1)] + latency, nan)
+            cats = plots.categoriseArrays(obs_a, obs_tw, alert_a)
+            for c in range(ncat):
+                prob[:, j, c] += (cats == c).sum(axis=0)
+                counts[k0:k0+nk, j, c] = (cats == c).sum(axis=1)
+            wt[k0:k0+nk, :, j] = where(cats == tpt, obs_tw - alert_a, nan)
+    prob /= nsamples
+    return stns, mmis, prob, wt, counts
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    fd_evid = sys.argv[2] # FinDer event ID
+    author = sys.argv[3] # FinDer pipeline author
+    adistfile = sys.argv[4] # Alert distance file, or GMICE name
+    mmi_tw = float(sys.argv[5]) # Target MMI to provide warning for, onset of damage
+    mag_w = float(sys.argv[6]) # Magnitude to issue warnings for
+    latency = float(sys.argv[7]) # Added latency for alerts
+    if len(sys.argv) > 8:
+        nsamples = int(sys.argv[8]) # Number of samples
+    if len(sys.argv) > 9:
+        sigma_gmice = float(sys.argv[9]) # GMICE sigma (MMI)
+    if len(sys.argv) > 10:
+        sigma_adist = float(sys.argv[10]) # Alert distance sigma (ln)
+    ###
+    ### Input parameters ###
+    ###
+
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    for fname in [ofname, os.path.join(evid, f'{fd_evid}.xml')]:
+        if not os.path.isfile(fname):
+            print(f'Cannot run ensemble as file {fname} is missing')
+            exit()
+    obs = plots.rdExceedanceTbl(ofname)
+    index = sweep.alertIndex(evid, fd_evid, author, adistfile)
+
+    stns, mmis, prob, wt, counts = ensemble(index, obs, mmi_tw, mag_w, latency)
+    with open(os.path.join(evid, f'{evid}_ensemble_{mag_w:.1f}_{latency:.0f}_mmitw-{mmi_tw}.dat'), 'w') as fout:
+        fout.write('# station mmi_a ' + ' '.join([f'P_{c}' for c in plots.CATEGORIES]) + ' wt_p5 wt_p50 wt_p95\n')
+        for j, mmi_a in enumerate(mmis):
+            for i, stn in enumerate(stns):
+                if isnan(wt[:, i, j]).all():
+                    wtp = [nan, nan, nan]
+                else:
+                    wtp = nanpercentile(wt[:, i, j], [5, 50, 95])
+                fout.write(f'{stn} {mmi_a} ' + ' '.join([f'{p:.3f}' for p in prob[i, j]]) +
+                           ' ' + ' '.join([f'{w:.2f}' for w in wtp]) + '\n')
+    for j, mmi_a in enumerate(mmis):
+        summary = []
+        for c, cat in enumerate(plots.CATEGORIES):
+            p5, p50, p95 = percentile(counts[:, j, c], [5, 50, 95])
+            summary.append(f'{cat} {p50:.0f} [{p5:.0f}-{p95:.0f}]')
+        print(f'MMI_alert {mmi_a}: ' + ', '.join(summary))
@@ -0,0 +1,245 @@
+import os
+from numpy import array, full, nan, inf, isnan, isinf, where, unique, minimum, maximum, searchsorted, \
+        int8, savez, load
+
+CATEGORIES = ['FP', 'TPU', 'TPT', 'TPL', 'FN', 'TN']
+
+# The event model is a dictionary of arrays sharing a station axis (stations sorted by name):
+#     stations, lat, lon, epidist: (station,)
+#     levels: observed MMI levels, exc: (station, level) exceedance times (s after origin, NaN if
+#         not exceeded), max: (station,) maximum MMI
+#     channels: channel ids, chanidx: station index of each channel, chanexc, chanmax: per channel
+# and, once alerts are joined (joinAlerts):
+#     amms: alert MMIs, alert: (station, alert MMI) first alert times (NaN if not alerted)
+#     times: (solution,) solution times, pred: (station, solution) predicted MMI, dist: (station,)
+#     fault distance for the last solution, alat, alon: (station,) alert site location,
+#     inalerts: (station,) station is in the alert table
+
+def reduceStations(chans, levels):
+    '''
+    Build the event model from per-channel exceedances (ms2mmi exceedance_times, keyed by channel
+    id), taking the earliest exceedance time and the largest MMI over the channels of a station as
+    grouped reductions
+    '''
+    ids = [c for c in chans if 'max' in chans[c]]
+    keys = array(['.'.join(c.split('.')[:2]) for c in ids])
+    stations, first, chanidx = unique(keys, return_index=True, return_inverse=True)
+    chanexc = array([[nan if chans[c][m] is None else chans[c][m] for m in levels] for c in ids]).reshape(len(ids), len(levels))
+    chanmax = array([chans[c]['max'] for c in ids], dtype=float)
+    exc = full((len(stations), len(levels)), inf)
+    minimum.at(exc, chanidx, where(isnan(chanexc), inf, chanexc))
+    exc[isinf(exc)] = nan
+    smax = full(len(stations), -inf)
+    maximum.at(smax, chanidx, chanmax)
+    loc = [chans[ids[i]]['location'] for i in first]
+    return {'stations': stations,
+            'lat': array([l['lat'] for l in loc]),
+            'lon': array([l['lon'] for l in loc]),
+            'epidist': array([l['epidist'] for l in loc]),
+            'levels': array(levels, dtype=float),
+            'exc': exc,
+            'max': smax,
+            'channels': array(ids),
+            'chanidx': chanidx,
+            'chanexc': chanexc,
+            'chanmax': chanmax}
+
+def toChannelDict(model):
+    '''
+    Per-channel exceedances (ms2mmi exceedance_times form) of an event model from reduceStations,
+    e.g. to merge new channels into an earlier run
+    '''
+    chans = {}
+    for i, c in enumerate(model['channels']):
+        s = model['chanidx'][i]
+        chans[str(c)] = {float(m): None if isnan(model['chanexc'][i, j]) else float(model['chanexc'][i, j])
+                         for j, m in enumerate(model['levels'])}
+        chans[str(c)]['location'] = {'lat': float(model['lat'][s]), 'lon': float(model['lon'][s]),
+                                     'epidist': float(model['epidist'][s])}
+        chans[str(c)]['max'] = float(model['chanmax'][i])
+    return chans
+
+def fromExceedanceDict(obs):
+    '''
+    Build the event model from an exceedance table (plots.rdExceedanceTbl)
+    '''
+    stations = sorted(obs)
+    levels = sorted([m for m in obs[stations[0]] if m not in ['location', 'max']]) if len(stations) > 0 else []
+    return {'stations': array(stations),
+            'lat': array([obs[s]['location']['lat'] for s in stations]),
+            'lon': array([obs[s]['location']['lon'] for s in stations]),
+            'epidist': array([obs[s]['location']['epidist'] for s in stations]),
+            'levels': array(levels, dtype=float),
+            'exc': array([[nan if obs[s][m] is None else obs[s][m] for m in levels] for s in stations]).reshape(len(stations), len(levels)),
+            'max': array([obs[s]['max'] for s in stations], dtype=float)}
+
+def toExceedanceDict(model):
+    '''
+    Exceedance table form of the event model (station: {level: time or None, 'location', 'max'})
+    '''
+    obs = {}
+    for i, stn in enumerate(model['stations']):
+        obs[str(stn)] = {float(m): None if isnan(model['exc'][i, j]) else float(model['exc'][i, j])
+                         for j, m in enumerate(model['levels'])}
+        obs[str(stn)]['location'] = {'lat': float(model['lat'][i]), 'lon': float(model['lon'][i]),
+                                     'epidist': float(model['epidist'][i])}
+        obs[str(stn)]['max'] = float(model['max'][i])
+    return obs
+
+def fromAlertDict(salerts):
+    '''
+    Alert arrays from an alert table (alert_times.computeAlerts, plots.rdAlertTbl)
+    Returns:
+        dictionary of names, amms, alert (site, alert MMI), times, pred (site, solution), dist, lat, lon
+    '''
+    names = sorted([s for s in salerts if s != 'times'])
+    amms = sorted(set([m for s in names for m in salerts[s] if m not in ['location', 'dist', 'pred', 'epidist']]))
+    times = array(salerts.get('times', []), dtype=float)
+    return {'names': array(names),
+            'amms': array(amms, dtype=float),
+            'alert': array([[salerts[s].get(m, nan) for m in amms] for s in names], dtype=float).reshape(len(names), len(amms)),
+            'times': times,
+            'pred': array([salerts[s]['pred'] for s in names], dtype=float).reshape(len(names), len(times)),
+            'dist': array([salerts[s].get('dist', nan) for s in names], dtype=float),
+            'lat': array([salerts[s]['location'][0] for s in names], dtype=float),
+            'lon': array([salerts[s]['location'][1] for s in names], dtype=float)}
+
+def joinIndex(stations, names):
+    '''
+    Index of each station in the sorted array names (-1 if not there)
+    '''
+    if len(names) == 0:
+        return full(len(stations), -1)
+    i = searchsorted(names, stations)
+    i[i == len(names)] = 0
+    return where(names[i] == stations, i, -1)
+
+def joinAlerts(model, arrays):
+    '''
+    Add the alert arrays (fromAlertDict) to the event model along its station axis
+    '''
+    i = joinIndex(model['stations'], arrays['names'])
+    found = i >= 0
+    model['inalerts'] = found
+    model['amms'] = arrays['amms']
+    model['times'] = arrays['times']
+    model['alert'] = full((len(i), len(arrays['amms'])), nan)
+    model['alert'][found] = arrays['alert'][i[found]]
+    model['pred'] = full((len(i), len(arrays['times'])), nan)
+    model['pred'][found] = arrays['pred'][i[found]]
+    model['dist'] = full(len(i), nan)
+    model['dist'][found] = arrays['dist'][i[found]]
+    for k in ['lat', 'lon']:
+        model[f'a{k}'] = full(len(i), nan)
+        model[f'a{k}'][found] = arrays[k][i[found]]
+    return model
+
+def toAlertDict(model):
+    '''
+    Alert table form of the alerts in the event model, for the stations in the alert table
+    '''
+    salerts = {'times': [float(t) for t in model['times']]}
+    for i, stn in enumerate(model['stations']):
+        if not model['inalerts'][i]:
+            continue
+        salerts[str(stn)] = {'location': [float(model['alat'][i]), float(model['alon'][i])],
+                             'pred': [float(p) for p in model['pred'][i]],
+                             'dist': float(model['dist'][i])}
+        for k, m in enumerate(model['amms']):
+            if not isnan(model['alert'][i, k]):
+                salerts[str(stn)][float(m)] = float(model['alert'][i, k])
+    return salerts
+
+def alertArraysToDict(arrays):
+    '''
+    Alert table form of alert arrays (fromAlertDict), for all sites
+    '''
+    return toAlertDict({'stations': arrays['names'], 'inalerts': full(len(arrays['names']), True),
+                        'alat': arrays['lat'], 'alon': arrays['lon'], 'times': arrays['times'],
+                        'amms': arrays['amms'], 'alert': arrays['alert'], 'pred': arrays['pred'],
+                        'dist': arrays['dist']})
+
+def wrModel(fname, model):
+    '''
+    Save an event model (or alert arrays) as npz
+    '''
+    savez(fname, **model)
+    return
+
+def rdModel(fname):
+    '''
+    Read an event model (or alert arrays) saved by wrModel
+    '''
+    data = load(fname)
+    return {k: data[k] for k in data.files}
+
+def modelFile(fname):
+    '''
+    The npz written alongside a table, or None if there is none or the table has been written since
+    '''
+    npz = fname.replace('.tbl', '.npz')
+    if os.path.isfile(npz) and os.path.getmtime(npz) >= os.path.getmtime(fname):
+        return npz
+    return None
+
+def rdEvent(evid, exc_fname, alert_fname=None):
+    '''
+    Event model of an event, from the npz written alongside each table unless the table is newer,
+    otherwise from the table itself, with the alerts joined if an alert table is given
+    '''
+    import plots
+    npz = modelFile(exc_fname)
+    if npz is not None:
+        model = rdModel(npz)
+    else:
+        model = fromExceedanceDict(plots.rdExceedanceTbl(exc_fname))
+    if alert_fname is not None:
+        npz = modelFile(alert_fname)
+        if npz is not None:
+            arrays = rdModel(npz)
+        else:
+            arrays = fromAlertDict(plots.rdAlertTbl(alert_fname))
+        joinAlerts(model, arrays)
+    return model
+
+def categoriseArrays(obs_a, obs_tw, alert_a):
+    '''
+    Array form of the sortCategories logic, for gridded or other array inputs.
+    Args:
+        obs_a: time mmi_a was observed (s after origin), NaN if never observed
+        obs_tw: time mmi_tw was observed, NaN if never observed
+        alert_a: time of the first alert for mmi_a, NaN if never alerted
+    Returns:
+        array of indices into CATEGORIES
+    '''
+    observed = ~isnan(obs_a)
+    alerted = ~isnan(alert_a)
+    strong = ~isnan(obs_tw)
+    cats = full(obs_a.shape, CATEGORIES.index('TN'), dtype=int8)
+    cats[~observed & alerted] = CATEGORIES.index('FP')
+    cats[observed & ~alerted] = CATEGORIES.index('FN')
+    cats[observed & alerted & ~strong] = CATEGORIES.index('TPL')
+    tp = observed & alerted & strong
+    late = tp.copy()
+    late[tp] = alert_a[tp] > obs_tw[tp]
+    cats[tp & ~late] = CATEGORIES.index('TPT')
+    cats[late] = CATEGORIES.index('TPU')
+    return cats
+
+def categories(model, mmi_tw):
+    '''
+    Categories of the stations in the alert table for each alert MMI
+    Returns:
+        stations: indices of the stations in the alert table
+        cats: dictionary by alert MMI of arrays of indices into CATEGORIES
+    '''
+    levels = [float(m) for m in model['levels']]
+    stations = model['inalerts'].nonzero()[0]
+    obs_tw = model['exc'][stations, levels.index(mmi_tw)]
+    cats = {}
+    for k, mmi_a in enumerate(model['amms']):
+        mmi_a = float(mmi_a)
+        if mmi_a not in levels:
+            continue
+        cats[mmi_a] = categoriseArrays(model['exc'][stations, levels.index(mmi_a)], obs_tw, model['alert'][stations, k])
+    return stations, cats
@@ -0,0 +1,113 @@
+'''
+Local stand-in for an FDSN dataselect web service, serving miniseed files from a directory.
+Used to test and time eew_utils.downloadWF without a remote server:
+    python fdsn_standin.py <msdir> [port] [failure rate]
+    client = eew_utils.getClient('http://localhost:<port>')
+'''
+
+import os, sys
+import random
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import obspy as ob
+
+def rdArchive(msdir):
+    '''
+    Read all miniseed files in a directory into a single stream
+    '''
+    st = ob.Stream()
+    for ms in sorted(os.listdir(msdir)):
+        st += ob.read(os.path.join(msdir, ms))
+    return st
+
+def selectData(st, net, sta, loc, cha, t1, t2):
+    '''
+    Select and trim the archive for one dataselect request line
+    '''
+    if loc == '--':
+        loc = ''
+    sel = st.select(network=net, station=sta, location=loc, channel=cha)
+    return sel.slice(ob.UTCDateTime(t1), ob.UTCDateTime(t2))
+
+def makeHandler(st, failrate=0.):
+
+    class DataselectHandler(BaseHTTPRequestHandler):
+
+        def sendStream(self, sel):
+            if random.random() < failrate:
+                self.send_error(503, 'Service temporarily unavailable (stand-in failure)')
+                return
+            if len(sel) == 0:
+                self.send_response(204)
+                self.end_headers()
+                return
+            buf = BytesIO()
+            sel.write(buf, format='MSEED')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.fdsn.mseed')
+            self.send_header('Content-Length', str(buf.tell()))
+            self.end_headers()
+            self.wfile.write(buf.getvalue())
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.endswith('/version'):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'1.1.0')
+                return
+            if not url.path.endswith('/dataselect/1/query'):
+                self.send_error(404)
+                return
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            t1 = q.get('starttime', q.get('start'))
+            t2 = q.get('endtime', q.get('end'))
+            if t1 is None or t2 is None:
+                self.send_error(400, 'starttime and endtime are required')
+                return
+            try:
+                sel = selectData(st,
+                    q.get('network', q.get('net', '*')), q.get('station', q.get('sta', '*')),
+                    q.get('location', q.get('loc', '*')), q.get('channel', q.get('cha', '*')), t1, t2)
+            except (TypeError, ValueError) as e:
+                self.send_error(400, f'Bad time: {e}')
+                return
+            self.sendStream(sel)
+
+        def do_POST(self):
+            if not urlparse(self.path).path.endswith('/dataselect/1/query'):
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            sel = ob.Stream()
+            for l in body.splitlines():
+                fs = l.split()
+                if len(fs) != 6 or '=' in l:
+                    continue
+                try:
+                    sel += selectData(st, *fs)
+                except (TypeError, ValueError) as e:
+                    self.send_error(400, f'Bad time in {l}: {e}')
+                    return
+            self.sendStream(sel)
+
+        def log_message(self, format, *args):
+            return
+
+    return DataselectHandler
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    msdir = sys.argv[1] # Directory of miniseed files to serve
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080 # Port to listen on
+    failrate = float(sys.argv[3]) if len(sys.argv) > 3 else 0. # Fraction of requests to fail (503)
+    ###
+    ### Input parameters ###
+    ###
+
+    st = rdArchive(msdir)
+    print(f'Serving {len(st)} traces from {msdir} on http://localhost:{port}')
+    ThreadingHTTPServer(('localhost', port), makeHandler(st, failrate)).serve_forever()
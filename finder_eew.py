@@ -0,0 +1,80 @@
+import sys
+import time
+import argparse
+import importlib
+import runpy
+
+tstart = time.perf_counter()
+
+# Subcommand: script module, positional arguments (optional ones end in ?) and help
+SUBCOMMANDS = {
+    'ms2mmi': ('ms2mmi', ['evid', 'gmice?', 'component?'], 'station MMI exceedance times from waveforms'),
+    'alerts': ('alert_times', ['evid', 'fd_evid', 'authors', 'adistfile', 'mag_w', 'latency', 'raster?'],
+               'alert times per site from the FinDer solutions'),
+    'plots': ('plots', ['evid', 'mmi_tw', 'mag_w', 'latency', 'fd_evid', 'authors?'], 'EEW performance plots'),
+    'animate': ('animate', ['evid', 'mmi_a', 'mag_w', 'latency', 'fd_evid', 'author?', 'workers?'],
+                'animation of the alerts and observed exceedances over the FinDer solutions'),
+    'sweep': ('sweep', ['evid', 'fd_evid', 'author', 'adistfile', 'mmi_tw', 'latency?', 'magmin?', 'magmax?', 'magstep?'],
+              'category counts against magnitude threshold'),
+    'metrics': ('metrics', ['evid', 'mmi_tw', 'mag_w', 'maxlat?', 'distfile?', 'classfile?', 'authors?'],
+                'category counts and warning times against latency'),
+    'ensemble': ('ensemble', ['evid', 'fd_evid', 'author', 'adistfile', 'mmi_tw', 'mag_w', 'latency', 'samples?', 'sigma_gmice?', 'sigma_adist?'],
+                 'Monte-Carlo GMICE and alert distance uncertainty'),
+    'dists': ('alert_dists', ['gmice', 'vs30?', 'gmpe?'], 'alert distance table from a GMPE and GMICE'),
+    'catalogue': ('catalogue', ['command', 'arg?'], 'FinDer solution catalogue: ingest [root] or query "SQL"'),
+}
+HEAVY = ['obspy', 'matplotlib', 'cartopy', 'scipy'] # packages reported if a subcommand loaded them
+
+def buildParser():
+    '''
+    Argument parser with a subcommand per script, taking the script's positional arguments
+    '''
+    parser = argparse.ArgumentParser(description='FinDer EEW performance tools')
+    sub = parser.add_subparsers(dest='subcommand', required=True)
+    for name, (module, args, helpstr) in SUBCOMMANDS.items():
+        p = sub.add_parser(name, help=helpstr, description=f'{helpstr} ({module}.py)')
+        for a in args:
+            if a.endswith('?'):
+                p.add_argument(a[:-1], nargs='?')
+            else:
+                p.add_argument(a)
+    return parser
+
+def runScript(module, argv):
+    '''
+    Run a script module as __main__ with its positional arguments. With alter_sys the module is
+    sys.modules['__main__'] while it runs, so functions it hands to a multiprocessing Pool
+    (animate.renderFrames) can be pickled
+    Returns:
+        timings: dictionary of the import (module level) and run times (s)
+    '''
+    t0 = time.perf_counter()
+    importlib.import_module(module)
+    t1 = time.perf_counter()
+    saved = sys.argv
+    sys.argv = [f'{module}.py'] + argv
+    try:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+    finally:
+        sys.argv = saved
+    return {'import': t1 - t0, 'run': time.perf_counter() - t1}
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    args = buildParser().parse_args()
+    ###
+    ### Input parameters ###
+    ###
+
+    module, names, helpstr = SUBCOMMANDS[args.subcommand]
+    argv = [getattr(args, a.rstrip('?')) for a in names]
+    # Optional arguments are positional in the scripts, so stop at the first one not given
+    if None in argv:
+        argv = argv[:argv.index(None)]
+    tparse = time.perf_counter() - tstart
+    timings = runScript(module, argv)
+    loaded = [p for p in HEAVY if p in sys.modules]
+    print(f'{args.subcommand}: CLI {tparse:.2f}s, {module} imports {timings["import"]:.2f}s, '
+          f'run {timings["run"]:.2f}s (loaded: {", ".join(loaded) if len(loaded) > 0 else "none"})', file=sys.stderr)
@@ -0,0 +1,110 @@
+from numpy import arange, where, asarray, clip, floor, float32, power
+
+# GMICE registry. Each relation is bilinear in log10(ground motion) for PGA (cm/s/s) and PGV (cm/s):
+#     MMI = c1 + c2 * log10(Y)  for log10(Y) < t1 (MMI < t2)
+#     MMI = c3 + c4 * log10(Y)  otherwise
+# stored as (c1, c2, c3, c4, t1, t2), with the range MMI is clipped to when PGA and PGV are combined
+GMICES = {
+    'moratalla': {'ref': 'Moratalla et al (2021), eqn 3, table 2',
+                  'pga': (1.7601, 1.992, -1.9095, 3.9322, 1.89137, 5.52777),
+                  'pgv': (4.107, 1.6323, 1.897, 3.837, 1.0024, 5.7433),
+                  'range': (2.0, 9.0)},
+    'worden2012': {'ref': 'Worden et al (2012), eqn 3, table 1 (without magnitude and distance terms)',
+                   'pga': (1.78, 1.55, -1.60, 3.70, 1.57, 4.22),
+                   'pgv': (3.78, 1.47, 2.89, 3.16, 0.53, 4.56),
+                   'range': (1.0, 10.0)},
+}
+
+lutmin = -4. # log10 ground motion range and spacing of the lookup tables
+lutmax = 4.
+lutstep = 0.001
+luts = {}
+
+def getGMICE(name):
+    '''
+    Return the coefficients of a GMICE by name
+    '''
+    if name not in GMICES:
+        raise ValueError(f'Unknown GMICE {name}, choose from {", ".join(GMICES)}')
+    return GMICES[name]
+
+def alertDistFile(name):
+    '''
+    Alert distance table (magnitude mmi distance) for a GMICE
+    '''
+    return f'{name}_alert_distances.tbl'
+
+def forward(coef, log10gm):
+    '''
+    Bilinear kernel, log10 ground motion to MMI (any array shape)
+    '''
+    c1, c2, c3, c4, t1, t2 = coef
+    return where(log10gm < t1, c1 + c2 * log10gm, c3 + c4 * log10gm)
+
+def inverse(coef, mmi):
+    '''
+    Bilinear inverse kernel, MMI to ground motion (any array shape)
+    '''
+    c1, c2, c3, c4, t1, t2 = coef
+    return power(10., where(mmi < t2, (mmi - c1) / c2, (mmi - c3) / c4))
+
+def buildLUT(name):
+    '''
+    MMI lookup tables of PGA and PGV on a regular log10 ground motion grid (float32)
+    '''
+    if name not in luts:
+        g = getGMICE(name)
+        x = arange(lutmin, lutmax + lutstep / 2., lutstep)
+        luts[name] = {'pga': forward(g['pga'], x).astype(float32),
+                      'pgv': forward(g['pgv'], x).astype(float32)}
+    return luts[name]
+
+def lookup(table, log10gm):
+    '''
+    Nearest grid value of a lookup table, log10 ground motion outside the grid is clamped
+    '''
+    i = clip(floor((log10gm - lutmin) / lutstep + 0.5), 0, len(table) - 1).astype(int)
+    return table[i]
+
+def gm2mmiArray(log10pga=None, log10pgv=None, name='moratalla', lut=False):
+    '''
+    Input log10(ground motion) PGA (cm/s/s) and/or PGV (cm/s), arrays of any shape
+    Output MMI, the mean of the PGA and PGV MMI if both are given, clipped to the GMICE range
+    lut: use the precomputed lookup tables (to lutstep in log10 ground motion) rather than the kernels
+    '''
+    if log10pga is None and log10pgv is None:
+        return None
+    g = getGMICE(name)
+    mmi = {}
+    for gm, x in [('pga', log10pga), ('pgv', log10pgv)]:
+        if x is None:
+            continue
+        if lut:
+            mmi[gm] = lookup(buildLUT(name)[gm], x)
+        else:
+            mmi[gm] = forward(g[gm], x)
+    if log10pga is None:
+        mean_mmi = mmi['pgv']
+    elif log10pgv is None:
+        mean_mmi = mmi['pga']
+    else:
+        mean_mmi = (mmi['pga'] + mmi['pgv'])/2. # mean
+    return clip(mean_mmi, g['range'][0], g['range'][1])
+
+def mmi2gmArray(mmi, name='moratalla'):
+    '''
+    Input MMI (scalar or array)
+    Output dictionary of PGA (cm/s/s) and PGV (cm/s) arrays of the same shape
+    '''
+    g = getGMICE(name)
+    mmi = asarray(mmi, dtype=float)
+    return {'pga': inverse(g['pga'], mmi), 'pgv': inverse(g['pgv'], mmi)}
+
+def mmi2gmTBL(name='moratalla', mmis=None):
+    '''
+    Create a dictionary with MMI as key and value as a dictionary of 'pga' (cm/s/s) and 'pgv' (cm/s)
+    '''
+    if mmis is None:
+        mmis = arange(2.5, 9.0, 0.5)
+    gm = mmi2gmArray(mmis, name)
+    return {mmi: {'pga': float(gm['pga'][i]), 'pgv': float(gm['pgv'][i])} for i, mmi in enumerate(mmis)}
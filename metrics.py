@@ -0,0 +1,163 @@
+import os, sys
+from numpy import array, nan, isnan, sort, searchsorted, arange, bincount, zeros, floor, minimum, clip
+
+import plots
+
+def obsAlertArrays(obs, alerts, mmi_a, mmi_tw):
+    '''
+    Arrays of observed and alert times (NaN where not observed or not alerted) for the stations
+    in both the exceedance and alert tables
+    '''
+    stns = [s for s in obs if s in alerts and s != 'times']
+    obs_a = array([nan if obs[s][mmi_a] is None else obs[s][mmi_a] for s in stns])
+    obs_tw = array([nan if obs[s][mmi_tw] is None else obs[s][mmi_tw] for s in stns])
+    alert_a = array([alerts[s].get(mmi_a, nan) for s in stns])
+    return stns, obs_a, obs_tw, alert_a
+
+def baseWarningTimes(obs, alerts, mmi_a, mmi_tw):
+    '''
+    Categories at zero latency and the base warning time of each station. Latency only delays
+    the alert, so the warning time at latency L is the base warning time minus L, and only the
+    split between TPT and TPU depends on latency.
+    Returns:
+        stns: station names
+        cats: categories at zero latency (indices into plots.CATEGORIES)
+        wt0: base warning time for TP stations that observed mmi_tw (NaN otherwise)
+    '''
+    stns, obs_a, obs_tw, alert_a = obsAlertArrays(obs, alerts, mmi_a, mmi_tw)
+    cats = plots.categoriseArrays(obs_a, obs_tw, alert_a)
+    tp = (cats == plots.CATEGORIES.index('TPT')) | (cats == plots.CATEGORIES.index('TPU'))
+    wt0 = obs_tw - alert_a
+    wt0[~tp] = nan
+    return stns, cats, wt0
+
+def latencyCurves(cats, wt0, latencies, quantiles=(0.1, 0.5, 0.9)):
+    '''
+    Category counts and TPT warning time quantiles as functions of latency, from one sort of the
+    base warning times
+    Args:
+        cats, wt0: output of baseWarningTimes
+        latencies: array of latencies (s)
+        quantiles: warning time quantiles over TPT stations
+    Returns:
+        curves: dictionary of arrays over latencies, one per category and one per quantile
+    '''
+    counts = bincount(cats, minlength=len(plots.CATEGORIES))
+    curves = {}
+    for i, cat in enumerate(plots.CATEGORIES):
+        curves[cat] = zeros(len(latencies)) + counts[i]
+    w = sort(wt0[~isnan(wt0)])
+    n = len(w)
+    k = searchsorted(w, latencies, side='left') # stations alerted too late at each latency
+    curves['TPT'] = n - k
+    curves['TPU'] = k
+    for q in quantiles:
+        pos = k + q * (n - k - 1)
+        i0 = clip(floor(pos).astype(int), 0, max(n - 1, 0))
+        i1 = minimum(i0 + 1, max(n - 1, 0))
+        if n == 0:
+            curves[f'q{q}'] = zeros(len(latencies)) + nan
+            continue
+        wq = w[i0] + (pos - i0) * (w[i1] - w[i0]) - latencies
+        wq[n - k == 0] = nan
+        curves[f'q{q}'] = wq
+    return curves
+
+def expectedTPT(stns, wt0, latencies, dists, classes):
+    '''
+    Expected number of TPT stations when each site has its own latency distribution, e.g. by
+    telemetry type, in addition to the common latency
+    Args:
+        dists: dictionary of latency samples (s) by class
+        classes: dictionary of class by station, stations without a class use class '*'
+            (no added latency if there is no distribution for the class)
+    Returns:
+        array over latencies of the expected TPT count
+    '''
+    sdists = {c: sort(array(dists[c])) for c in dists}
+    nodist = array([0.])
+    ett = zeros(len(latencies))
+    for s, w in zip(stns, wt0):
+        if isnan(w):
+            continue
+        d = sdists.get(classes.get(s, '*'), nodist)
+        # P(site latency <= w - L)
+        ett += searchsorted(d, w - latencies, side='right') / len(d)
+    return ett
+
+def rdLatencyDists(fname):
+    '''
+    Site latency distributions, one class per line: class latency1 latency2 ...
+    '''
+    dists = {}
+    with open(fname, 'r') as fin:
+        for l in fin:
+            if l.startswith('#') or len(l.split()) < 2:
+                continue
+            fs = l.split()
+            dists[fs[0]] = [float(x) for x in fs[1:]]
+    return dists
+
+def rdSiteClasses(fname):
+    '''
+    Site latency classes, one site per line: NET.STA class
+    '''
+    classes = {}
+    with open(fname, 'r') as fin:
+        for l in fin:
+            if l.startswith('#') or len(l.split()) < 2:
+                continue
+            fs = l.split()
+            classes[fs[0]] = fs[1]
+    return classes
+
+def wrLatencyCurves(fname, latencies, allcurves):
+    '''
+    Write latency curves for all alert MMIs: latency then one column per alert MMI and quantity
+    '''
+    keys = [(mmi_a, k) for mmi_a in allcurves for k in allcurves[mmi_a]]
+    with open(fname, 'w') as fout:
+        fout.write('# latency ' + ' '.join([f'{k}_mmi{mmi_a}' for mmi_a, k in keys]) + '\n')
+        for i, lat in enumerate(latencies):
+            fout.write(f'{lat:.2f} ' + ' '.join([f'{allcurves[mmi_a][k][i]:.3f}' for mmi_a, k in keys]) + '\n')
+    return
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    mmi_tw = float(sys.argv[2]) # Target MMI to provide warning for, onset of damage
+    mag_w = float(sys.argv[3]) # Magnitude to issue warnings for
+    maxlat = float(sys.argv[4]) if len(sys.argv) > 4 else 30. # Maximum latency (s)
+    distfile = sys.argv[5] if len(sys.argv) > 5 and sys.argv[5] != '-' else None # Optional site latency distributions ('-' for none)
+    classfile = sys.argv[6] if len(sys.argv) > 6 and sys.argv[6] != '-' else None # Optional site latency classes
+    authors = sys.argv[7].split(',') if len(sys.argv) > 7 else ['scfinder'] # FinDer pipeline author, or comma separated authors to compare
+    ###
+    ### Input parameters ###
+    ###
+
+    import alert_times as at
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    afnames = {author: at.alertFile(evid, mag_w, 0., None if len(authors) == 1 else author) for author in authors}
+    for fname in [ofname] + list(afnames.values()):
+        if not os.path.isfile(fname):
+            print(f'Cannot compute latency curves as file {fname} is missing')
+            exit()
+    obs = plots.rdExceedanceTbl(ofname)
+    dists = rdLatencyDists(distfile) if distfile is not None else None
+    classes = rdSiteClasses(classfile) if classfile is not None else {}
+
+    latencies = arange(0., maxlat + 0.05, 0.1)
+    for author, afname in afnames.items():
+        tag = '' if len(authors) == 1 else f'_{author}'
+        alerts = plots.rdAlertTbl(afname)
+        mmi_alerts = sorted(set([mmi for stn in alerts for mmi in alerts[stn] if stn != 'times' and mmi not in ['location', 'dist', 'pred', 'epidist']]))
+        allcurves = {}
+        for mmi_a in mmi_alerts:
+            stns, cats, wt0 = baseWarningTimes(obs, alerts, mmi_a, mmi_tw)
+            allcurves[mmi_a] = latencyCurves(cats, wt0, latencies)
+            if dists is not None:
+                allcurves[mmi_a]['ETPT'] = expectedTPT(stns, wt0, latencies, dists, classes)
+        wrLatencyCurves(os.path.join(evid, f'{evid}{tag}_latency_{mag_w:.1f}_mmitw-{mmi_tw}.dat'), latencies, allcurves)
+        plots.plotLatencyCurves(evid, mmi_tw, mag_w, latencies, allcurves, tag)
@@ -1,11 +1,32 @@
 import os, sys
+import json
 import obspy as ob
+from obspy.clients.filesystem.sds import Client as SDSClient
 import math
-from numpy import nonzero, log10, absolute, where, arange
+from numpy import nonzero, log10, absolute, where, arange, array, zeros, float32, gradient, newaxis, sqrt, \
+        add, maximum, logical_or
+from scipy.signal import butter, sosfilt
+from scipy.integrate import cumulative_trapezoid
 import geographiclib.geodesic as geo
 
 import eew_utils as utils
-import moratalla as gmice
+import event_model as em
+import gmice
+
+bWindowed = True # decode only the window around the expected shaking (see shakingWindow)
+wfpad = 30. # padding (s) either side of the shaking window, for the 0.075 Hz highpass transient
+wfdur = 120. # duration (s) of shaking allowed after the slowest (2 km/s) arrival
+locations = ['10', '20'] # This is a hack for New Zealand
+bSDS = False # read waveforms from the shared SDS archive (eew_utils.sdsroot) instead of <evid>_ms
+bBatch = True # process channels with the same sample rate together as 2-D arrays (see batchMMI)
+batchtraces = 500 # maximum number of traces in a batch
+hpfreq = 0.075 # highpass corner frequency (Hz)
+gmicename = 'moratalla' # GMICE from the gmice.py registry
+bLUT = False # convert ground motion to MMI with the GMICE lookup tables rather than the kernels
+bCheckpoint = True # append channel results to a checkpoint after each batch of files, and resume from it
+bIncremental = True # without a checkpoint, start from the channels and sources of an earlier run's npz and process only new sources
+component = 'channel' # ground motion per channel, or combined per sensor: 'vector' (3-component) or 'maxh' (larger horizontal)
+COMPONENTS = ['channel', 'vector', 'maxh']
 
 def calcdistaz(lat1, lon1, lat2, lon2):
     '''
@@ -19,61 +40,465 @@ def doTimeCheck(tr, origin_time, dist):
     '''
     Check there is data in the trace in the waveform window
     '''
+    return doTimeCheckRange(tr.stats.starttime, tr.stats.endtime, origin_time, dist)
+
+
+def doTimeCheckRange(starttime, endtime, origin_time, dist):
+    '''
+    Check a data time range overlaps the waveform window
+    '''
     # Check for relevant data window
     checktime = origin_time + (dist / 6.) - 10. # if no data after this time ignore
-    if tr.stats.endtime < checktime:
+    if endtime < checktime:
         return False
     checktime = origin_time + (dist / 3.) + 30. # if no data before this time ignore
-    if tr.stats.starttime > checktime:
+    if starttime > checktime:
+        return False
+    return True
+
+
+def shakingWindow(origin_time, dist):
+    '''
+    Time window containing the shaking at a station: from the earliest P arrival to the slowest
+    surface wave arrival plus a duration, padded for the filter transients
+    '''
+    return origin_time + (dist / 8.) - wfpad, origin_time + (dist / 2.) + wfdur + wfpad
+
+def screenMS(ms, metadata, origin_time, elat, elon):
+    '''
+    Read only the miniseed headers and return the channels worth decoding: in the selected
+    locations, with metadata and with data in the waveform window (doTimeCheck)
+    Returns:
+        chans: dictionary keyed by channel id of location ({'lat', 'lon', 'epidist'}) and
+        shaking window start and end times
+    '''
+    chans = {}
+    meta = {} # metadata and distance by channel, looked up once for all of its segments
+    for tr in ob.read(ms, headonly=True):
+        if tr.stats.location not in locations:
+            continue
+        stub = tr.get_id()
+        # A channel is only marked as seen once one of its segments passes the time check, so a
+        # first segment outside the window does not drop later usable segments
+        if stub in chans:
+            continue
+        if stub not in meta:
+            try:
+                sdict = metadata.get_channel_metadata(stub)
+                dist, az = calcdistaz(sdict['latitude'], sdict['longitude'], elat, elon)
+                meta[stub] = (sdict, dist)
+            except:
+                print(f'Failed to find metadata for {stub}')
+                meta[stub] = None
+        if meta[stub] is None:
+            continue
+        sdict, dist = meta[stub]
+        if not doTimeCheck(tr, origin_time, dist):
+            continue
+        t1, t2 = shakingWindow(origin_time, dist)
+        chans[stub] = {'location': {'lat': sdict['latitude'], 'lon': sdict['longitude'], 'epidist': dist},
+                       't1': t1, 't2': t2}
+    return chans
+
+def screenSDS(index, metadata, origin_time, elat, elon):
+    '''
+    Screen the channels held in the SDS archive using the archive index, without reading data
+    Returns:
+        groups: dictionary keyed by instrument (NET.STA.LOC.CH) of channel dictionaries as
+        returned by screenMS
+    '''
+    groups = {}
+    for stub in metadata.get_contents()['channels']:
+        if stub.split('.')[2] not in locations or stub not in index:
+            continue
+        try:
+            sdict = metadata.get_channel_metadata(stub)
+        except:
+            print(f'Failed to find metadata for {stub}')
+            continue
+        dist, az = calcdistaz(sdict['latitude'], sdict['longitude'], elat, elon)
+        if not any([doTimeCheckRange(ob.UTCDateTime(i[0]), ob.UTCDateTime(i[1]), origin_time, dist) for i in index[stub]]):
+            continue
+        t1, t2 = shakingWindow(origin_time, dist)
+        groups.setdefault(stub[:-1], {})[stub] = {
+                'location': {'lat': sdict['latitude'], 'lon': sdict['longitude'], 'epidist': dist},
+                't1': t1, 't2': t2}
+    return groups
+
+def readWindows(mslist, metadata, origin_time, elat, elon, sds=None, done=()):
+    '''
+    Pre-screen the waveforms, then decode only the usable channels and time window
+    Sources (miniseed files, or instruments in the SDS archive) in done are skipped, and sources
+    that fail to read are reported and skipped
+    Yields:
+        source, chans, st: source name, screened channels (see screenMS) and stream for each
+        miniseed file, or for each instrument in the SDS archive if sds (archive directory) is given
+    '''
+    if sds is not None:
+        client = SDSClient(sds)
+        for inst, chans in screenSDS(utils.rdSDSIndex(sds), metadata, origin_time, elat, elon).items():
+            if inst in done:
+                continue
+            s = inst.split('.')
+            try:
+                st = client.get_waveforms(s[0], s[1], s[2], f'{s[3]}?',
+                                          min([chans[c]['t1'] for c in chans]),
+                                          max([chans[c]['t2'] for c in chans]))
+            except Exception as e:
+                print(f'Failed to read {inst}: {e}')
+                continue
+            yield inst, chans, st
+        return
+    for ms in sorted(mslist):
+        source = os.path.basename(ms)
+        if source in done:
+            continue
+        try:
+            chans = screenMS(ms, metadata, origin_time, elat, elon)
+            if len(chans) == 0:
+                st = ob.Stream()
+            elif bWindowed:
+                st = ob.read(ms, starttime=min([chans[c]['t1'] for c in chans]),
+                             endtime=max([chans[c]['t2'] for c in chans]))
+            else:
+                st = ob.read(ms)
+        except Exception as e:
+            print(f'Failed to read {ms}: {e}')
+            continue
+        yield source, chans, st
+
+def updateExceedance(sdict, etimes, mmimax):
+    '''
+    Merge the exceedance times and maximum MMI of a trace into a channel entry of exceedance_times,
+    keeping the earliest exceedance time at each MMI level and the largest MMI
+    '''
+    for m in etimes:
+        if m in sdict:
+            if etimes[m] is not None:
+                if sdict[m] is None or etimes[m] < sdict[m]:
+                    sdict[m] = etimes[m]
+        else:
+            sdict[m] = etimes[m]
+    if 'max' in sdict:
+        if mmimax > sdict['max']:
+            sdict['max'] = mmimax
+    else:
+        sdict['max'] = mmimax
+    return
+
+def fillRow(row, tr, metadata):
+    '''
+    Copy a trace into a row of a batch array with baseline removal and gain correction, converting
+    m/s/s to cm/s/s (or m/s to cm/s)
+    Returns:
+        False if the trace has no response
+    '''
+    try:
+        sens = metadata.get_response(tr.get_id(), tr.stats.starttime).instrument_sensitivity.value
+    except Exception as e:
+        print(f'Failed to find response for {tr.get_id()}: {e}')
         return False
+    row[:] = tr.data
+    row -= row.mean()
+    row *= 100. / sens
     return True
 
+def groundMotion(data, rate, inst, starts, ends):
+    '''
+    Highpass (second-order sections) the rows of a batch array and return the absolute
+    acceleration and velocity, differentiating or integrating along the time axis
+    starts, ends: sample range of each row's data in the zero padded array. The central
+    differences at the ends of the data are replaced by one-sided differences, as for a trace on
+    its own, so the padding does not leak into the valid samples.
+    '''
+    delta = 1. / rate
+    sos = butter(4, hpfreq / (0.5 * rate), btype='highpass', output='sos').astype(float32)
+    data = sosfilt(sos, data, axis=1)
+    if inst == 'H': # assuming HH? = broadband and HN? = strong motion
+        acc = gradient(data, delta, axis=1)
+        rows = arange(data.shape[0])
+        s = array(starts)
+        e = array(ends)
+        fix = (e < data.shape[1]) & (e - s > 1)
+        acc[rows[fix], e[fix] - 1] = (data[rows[fix], e[fix] - 1] - data[rows[fix], e[fix] - 2]) / delta
+        fix = (s > 0) & (e - s > 1)
+        acc[rows[fix], s[fix]] = (data[rows[fix], s[fix] + 1] - data[rows[fix], s[fix]]) / delta
+        vel = data
+    else:
+        acc = data
+        vel = sosfilt(sos, cumulative_trapezoid(data, dx=delta, axis=1, initial=0), axis=1)
+    absolute(acc, out=acc)
+    absolute(vel, out=vel)
+    return acc, vel
+
+def exceedanceTimes(mmi, starttimes, delta, origin_time, mmilevels):
+    '''
+    First time (s after origin) each row of an MMI array exceeds each MMI level, None if it does not
+    Returns:
+        list of exceedance time dictionaries by MMI level, one per row
+    '''
+    etimes = [{} for t in starttimes]
+    for m in mmilevels:
+        exc = mmi > m
+        first = exc.argmax(axis=1)
+        for i, t in enumerate(starttimes):
+            if exc[i, first[i]]:
+                etimes[i][m] = t + (delta * first[i]) - origin_time
+            else:
+                etimes[i][m] = None
+    return etimes
+
+def resultId(stub):
+    '''
+    Key of the exceedance_times entry a channel contributes to: the channel, or the sensor with the
+    component mode (NET.STA.LOC.CH_vector or _maxh)
+    '''
+    return stub if component == 'channel' else f'{stub[:-1]}_{component}'
+
+def batchMMI(traces, metadata, origin_time, mmilevels):
+    '''
+    Batched form of the per-trace processing in ms2mmi. Traces with the same sample rate and
+    instrument type are demeaned into a zero padded 2-D float32 array, then the gain, highpass
+    (second-order sections), differentiation or integration and GMICE are applied along the time
+    axis for all rows at once. Padding follows the data so the causal filters do not change the
+    valid samples (differentiation is one-sided at the end of the data), and it is masked before
+    the exceedance times are taken.
+    Yields:
+        stub, etimes, mmimax: channel id, exceedance times (dict by MMI level) and maximum MMI
+    '''
+    groups = {}
+    for tr in traces:
+        groups.setdefault((tr.stats.sampling_rate, tr.stats.channel[1]), []).append(tr)
+    for (rate, inst), trs in groups.items():
+        npts = [tr.stats.npts for tr in trs]
+        data = zeros((len(trs), max(npts)), dtype=float32)
+        good = [fillRow(data[i, :npts[i]], tr, metadata) for i, tr in enumerate(trs)]
+        acc, vel = groundMotion(data, rate, inst, zeros(len(trs), dtype=int), npts)
+        mmi = gmice.gm2mmiArray(log10(where(acc > 0, acc, 0.0001)), log10(where(vel > 0, vel, 0.0001)), gmicename, bLUT)
+        del acc, vel, data
+        mmi[arange(mmi.shape[1])[newaxis, :] >= array(npts)[:, newaxis]] = 0.
+        etimes = exceedanceTimes(mmi, [tr.stats.starttime for tr in trs], 1. / rate, origin_time, mmilevels)
+        mmimax = mmi.max(axis=1)
+        for i, tr in enumerate(trs):
+            if good[i]:
+                yield tr.get_id(), etimes[i], mmimax[i]
+
+def sensorMMI(traces, metadata, origin_time, mmilevels):
+    '''
+    Three-component form of batchMMI. The channels of each sensor are merged (gaps interpolated)
+    and placed on a common sample grid from the earliest start, offsets rounded to the nearest
+    sample. All component rows of sensors with the same sample rate and instrument type are
+    processed as one batch array, then the absolute acceleration and velocity are combined over
+    each sensor's rows (reduceat) as the vector sum ('vector') or the larger horizontal ('maxh')
+    before the GMICE. Samples no component covers are masked.
+    Yields:
+        stub, etimes, mmimax: sensor id (resultId), exceedance times and maximum MMI
+    '''
+    sensors = {}
+    for tr in traces:
+        if component == 'maxh' and tr.stats.channel[2] not in 'EN12':
+            continue
+        sensors.setdefault(tr.get_id()[:-1], []).append(tr)
+    groups = {}
+    for sensor, trs in sensors.items():
+        try:
+            st = ob.Stream(trs).merge(method=1, fill_value='interpolate')
+        except Exception as e:
+            print(f'Failed to merge {sensor}: {e}')
+            continue
+        rates = set([tr.stats.sampling_rate for tr in st])
+        if len(rates) > 1:
+            print(f'Skipping {sensor}: components have different sample rates')
+            continue
+        groups.setdefault((rates.pop(), sensor[-1]), []).append((sensor, st))
+    for (rate, inst), sens in groups.items():
+        starts, offsets, t0s = [], [], []
+        for sensor, st in sens:
+            t0 = min([tr.stats.starttime for tr in st])
+            starts.append(len(offsets))
+            offsets += [int(round((tr.stats.starttime - t0) * rate)) for tr in st]
+            t0s.append(t0)
+        trs = [tr for sensor, st in sens for tr in st]
+        ends = [offsets[i] + tr.stats.npts for i, tr in enumerate(trs)]
+        data = zeros((len(trs), max(ends)), dtype=float32)
+        valid = zeros(data.shape, dtype=bool)
+        for i, tr in enumerate(trs):
+            valid[i, offsets[i]:ends[i]] = fillRow(data[i, offsets[i]:ends[i]], tr, metadata)
+        acc, vel = groundMotion(data, rate, inst, offsets, ends)
+        del data
+        acc[~valid] = 0.
+        vel[~valid] = 0.
+        if component == 'vector':
+            acc = sqrt(add.reduceat(acc * acc, starts, axis=0))
+            vel = sqrt(add.reduceat(vel * vel, starts, axis=0))
+        else:
+            acc = maximum.reduceat(acc, starts, axis=0)
+            vel = maximum.reduceat(vel, starts, axis=0)
+        valid = logical_or.reduceat(valid, starts, axis=0)
+        mmi = gmice.gm2mmiArray(log10(where(acc > 0, acc, 0.0001)), log10(where(vel > 0, vel, 0.0001)), gmicename, bLUT)
+        del acc, vel
+        mmi[~valid] = 0.
+        etimes = exceedanceTimes(mmi, t0s, 1. / rate, origin_time, mmilevels)
+        mmimax = mmi.max(axis=1)
+        for i, (sensor, st) in enumerate(sens):
+            if valid[i].any():
+                yield f'{sensor}_{component}', etimes[i], mmimax[i]
+
+def processMMI(traces, metadata, origin_time, mmilevels):
+    '''
+    batchMMI, or sensorMMI for the sensor component modes (the components of a sensor are expected
+    in the same miniseed file or SDS instrument, so they are in the same batch)
+    '''
+    if component == 'channel':
+        return batchMMI(traces, metadata, origin_time, mmilevels)
+    return sensorMMI(traces, metadata, origin_time, mmilevels)
+
+def ckptConfig():
+    '''
+    Settings the channel results depend on, a checkpoint made with other settings is not resumed
+    '''
+    return {'gmice': gmicename, 'lut': bLUT, 'component': component, 'hpfreq': hpfreq, 'locations': locations,
+            'windowed': bWindowed, 'wfpad': wfpad, 'wfdur': wfdur, 'batch': bBatch}
+
+def rdCheckpoint(fname):
+    '''
+    Read a checkpoint: a header line of ckptConfig then one JSON line per batch of completed sources
+    with the results of the channels they updated. A partly written last line (a crash while
+    writing) is cut off. A missing or corrupt checkpoint, or one with other settings (including
+    bBatch, as the float32 batch and per-trace paths differ slightly), is started afresh.
+    Returns:
+        exceedance_times: channel results as in ms2mmi
+        done: set of completed source names
+    '''
+    exceedance_times = {}
+    done = set()
+    good = 0
+    if os.path.isfile(fname):
+        with open(fname, 'r') as fin:
+            lines = fin.readlines()
+        header = None
+        if len(lines) > 0 and lines[0].endswith('\n'):
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                print(f'Corrupt checkpoint header in {fname}, starting afresh')
+        if header == {'config': ckptConfig()}:
+            good = len(lines[0])
+            for l in lines[1:]:
+                try:
+                    rec = json.loads(l)
+                except ValueError:
+                    break
+                if not l.endswith('\n'):
+                    break
+                for stub, entry in rec['channels'].items():
+                    if stub not in exceedance_times:
+                        exceedance_times[stub] = {'location': entry['location']}
+                    updateExceedance(exceedance_times[stub], {float(m): t for m, t in entry['etimes'].items()}, entry['max'])
+                done.update(rec['sources'])
+                good += len(l)
+    if good == 0:
+        with open(fname, 'w') as fout:
+            fout.write(json.dumps({'config': ckptConfig()}) + '\n')
+    else:
+        with open(fname, 'r+') as fout:
+            fout.truncate(good)
+    return exceedance_times, done
+
+def wrCheckpoint(fname, sources, exceedance_times, stubs):
+    '''
+    Append the completed sources and the current results of the channels in stubs to the checkpoint
+    '''
+    channels = {}
+    for stub in stubs:
+        entry = exceedance_times[stub]
+        if 'max' not in entry:
+            continue
+        channels[stub] = {'location': entry['location'], 'max': float(entry['max']),
+                          'etimes': {str(float(m)): entry[m] for m in entry if m not in ['location', 'max']}}
+    with open(fname, 'a') as fout:
+        fout.write(json.dumps({'sources': sources, 'channels': channels}) + '\n')
+        fout.flush()
+        os.fsync(fout.fileno())
+    return
+
+def exceedanceFile(name, comp='channel'):
+    '''
+    Exceedance table file name, with the GMICE name for other than the default (moratalla) and the
+    component mode for other than per channel
+    '''
+    return 'exceedance_times' + ('' if name == 'moratalla' else f'_{name}') + ('' if comp == 'channel' else f'_{comp}') + '.tbl'
 
-def ms2mmi(ev, mslist, metadata):
+def ms2mmi(ev, mslist, metadata, sds=None):
     '''
     Compute MMI exceedence times after origin time that MMI is exceeded at a station
     Miniseed is read in and converted to acceleration and velocity using the remove_response function
     Data are demeaned and converted to cm/s/s or cm/s (from m/s/s or m/s)
     Exceedence is computed on a per-channel basis (not combined horizontals), and then the minimum time is taken from all channels for a sensor
+    (event_model.reduceStations), the event model is saved as npz alongside the table
+    Waveforms are read from the miniseed files in mslist, or from the SDS archive directory sds
     '''
     origin_time = ev.preferred_origin().time
     elat = ev.preferred_origin().latitude
     elon = ev.preferred_origin().longitude
     mmilevels = arange(2.5, 9, 0.5)
-    exceedance_times = {}
-    for ms in sorted(mslist):
-        st = ob.read(ms)
+    evid = ev.resource_id.id.split(os.path.sep)[-1]
+    fname = os.path.join(evid, exceedanceFile(gmicename, component))
+    ckpt = fname.replace('.tbl', '.ckpt')
+    if bCheckpoint:
+        exceedance_times, done = rdCheckpoint(ckpt)
+        if len(done) > 0:
+            print(f'Resuming from {ckpt}: {len(done)} sources, {len(exceedance_times)} channels done')
+    else:
+        exceedance_times, done = {}, set()
+    npz = fname.replace('.tbl', '.npz')
+    if bIncremental and len(exceedance_times) == 0 and os.path.isfile(npz):
+        # Earlier run without a checkpoint: keep its channels and sources if made with the same
+        # settings, and checkpoint them for later runs
+        prev = em.rdModel(npz)
+        if 'config' in prev and json.loads(str(prev['config'])) == ckptConfig():
+            exceedance_times = em.toChannelDict(prev)
+            done = set([str(x) for x in prev['sources']])
+            print(f'Updating {npz}: {len(done)} sources, {len(exceedance_times)} channels done')
+            if bCheckpoint:
+                wrCheckpoint(ckpt, sorted(done), exceedance_times, list(exceedance_times))
+    # Only sources not yet processed are read; their channels are merged into any earlier results
+    # for the same channel (updateExceedance)
+    alldone = set(done)
+    pending = []
+    sources = []
+    stubs = set()
+    # Traces are batched and checkpointed at file (or SDS instrument) boundaries, so at most one file
+    # beyond batchtraces is held in memory and a checkpoint only records complete files
+    for source, chans, st in readWindows(mslist, metadata, origin_time, elat, elon, sds, done):
         for tr in st:
-            if tr.stats.location not in ['10', '20']: # This is a hack for New Zealand
-                continue
             stub = tr.get_id()
-            if stub not in exceedance_times:
-                try:
-                    sdict = metadata.get_channel_metadata(tr.get_id())
-                except:
-                    print(f'Failed to find metadata for {tr.get_id()}')
-                    continue
-                dist, az = calcdistaz(sdict['latitude'], sdict['longitude'], elat, elon)
-                if not doTimeCheck(tr, origin_time, dist):
-                    continue
-                exceedance_times[stub] = {}
-                exceedance_times[stub]['location'] = {'lat': sdict['latitude'], 'lon': sdict['longitude'], 'epidist': dist}
+            if stub not in chans:
+                continue
+            if not doTimeCheck(tr, origin_time, chans[stub]['location']['epidist']):
+                continue
+            key = resultId(stub)
+            if key not in exceedance_times:
+                exceedance_times[key] = {}
+                exceedance_times[key]['location'] = chans[stub]['location']
+            stubs.add(key)
+            if bBatch or component != 'channel':
+                pending.append(tr)
+                continue
             inv = metadata.select(network=tr.stats.network, 
                                   station=tr.stats.station,
                                   location=tr.stats.location, 
                                   channel=tr.stats.channel)
-            dist, az = calcdistaz(exceedance_times[stub]['location']['lat'], 
-                                  exceedance_times[stub]['location']['lon'], 
-                                  elat, 
-                                  elon)
-            if not doTimeCheck(tr, origin_time, dist):
-                continue
             # baseline removal
             tr.detrend('demean')
             # gain correction
-            tr.remove_sensitivity(inventory=inv)
+            try:
+                tr.remove_sensitivity(inventory=inv)
+            except Exception as e:
+                print(f'Failed to find response for {stub}: {e}')
+                continue
             tr.data *= 100. # convert m/s/s to cm/s/s
-            tr.filter('highpass', freq=0.075)
+            tr.filter('highpass', freq=hpfreq)
             # ground motion types
             acc = tr.copy()
             vel = tr.copy()
@@ -81,10 +506,10 @@ def ms2mmi(ev, mslist, metadata):
                 acc.differentiate()
             else:
                 vel.integrate()
-                vel.filter('highpass', freq=0.075)
+                vel.filter('highpass', freq=hpfreq)
             inpga = log10(where(absolute(acc.data) > 0, absolute(acc.data), 0.0001))
             inpgv = log10(where(absolute(vel.data) > 0, absolute(vel.data), 0.0001))
-            mmi = gmice.gm2mmiArray(inpga, inpgv)
+            mmi = gmice.gm2mmiArray(inpga, inpgv, gmicename, bLUT)
             if False:
                 outname = f'{tr.get_id()}.png'
                 i = 1
@@ -104,47 +529,41 @@ def ms2mmi(ev, mslist, metadata):
                 ax[4].plot(inpgv)
                 ax[4].set_ylabel('log10(Vel)')
                 plt.savefig(outname)
+            etimes = {}
             for m in mmilevels:
                 ind = nonzero(mmi > m)
                 if len(ind[0]) > 0: 
-                    etime = tr.stats.starttime + (tr.stats.delta * ind[0][0]) - origin_time
+                    etimes[m] = tr.stats.starttime + (tr.stats.delta * ind[0][0]) - origin_time
                     #if etime < 0:
                     #    print(tr.stats, etime)
                 else:
-                    etime = None
-                if m in exceedance_times[stub]:
-                    if etime is not None:
-                        if exceedance_times[stub][m] is None or etime < exceedance_times[stub][m]:
-                            exceedance_times[stub][m] = etime
-                else:
-                    exceedance_times[stub][m] = etime
-            if 'max' in exceedance_times[stub]:
-                if max(mmi) > exceedance_times[stub]['max']:
-                    exceedance_times[stub]['max'] = max(mmi)
-            else:
-                exceedance_times[stub]['max'] = max(mmi)
-
-    exc_times = {}
-    stubs = set(['.'.join(x.split('.')[:2]) for x in exceedance_times])
-    for stub in sorted(stubs):
-        exc_times[stub] = {}
-        stnlist = [x for x in exceedance_times if '.'.join(x.split('.')[:2]) == stub and 'location' in exceedance_times[x] and len(exceedance_times[x]) > 0]
-        for m in mmilevels:
-            mint = None
-            location = None
-            for stn in stnlist:
-                location = exceedance_times[stn]['location']
-                if exceedance_times[stn][m] is not None:
-                    if mint is None or exceedance_times[stn][m] < mint:
-                        mint = exceedance_times[stn][m]
-            exc_times[stub][m] = mint
-            exc_times[stub]['location'] = location
-        exc_times[stub]['max'] = max([exceedance_times[x]['max'] for x in stnlist])
+                    etimes[m] = None
+            updateExceedance(exceedance_times[stub], etimes, max(mmi))
+        sources.append(source)
+        alldone.add(source)
+        if len(pending) >= batchtraces or not bBatch:
+            for key, etimes, mmimax in processMMI(pending, metadata, origin_time, mmilevels):
+                updateExceedance(exceedance_times[key], etimes, mmimax)
+            if bCheckpoint:
+                wrCheckpoint(ckpt, sources, exceedance_times, stubs)
+            pending = []
+            sources = []
+            stubs = set()
+    for key, etimes, mmimax in processMMI(pending, metadata, origin_time, mmilevels):
+        updateExceedance(exceedance_times[key], etimes, mmimax)
+    if bCheckpoint and len(sources) > 0:
+        wrCheckpoint(ckpt, sources, exceedance_times, stubs)
 
-    evid = ev.resource_id.id.split(os.path.sep)[-1]
-    with open(os.path.join(evid, 'exceedance_times.tbl'), 'w') as fout:
+    model = em.reduceStations(exceedance_times, mmilevels)
+
+    model['config'] = array(json.dumps(ckptConfig()))
+    model['sources'] = array(sorted(alldone), dtype=str)
+    exc_times = em.toExceedanceDict(model)
+    with open(fname, 'w') as fout:
         for stn in exc_times:
             fout.write(f'{stn} {exc_times[stn]}\n')
+    # after the table, so event_model.rdEvent sees the npz as current
+    em.wrModel(npz, model)
     return
 
 if __name__ == '__main__':
@@ -152,6 +571,13 @@ if __name__ == '__main__':
     ### Input parameters ###
     ###
     evid = sys.argv[1] # GeoNet event ID
+    if len(sys.argv) > 2:
+        gmicename = sys.argv[2] # GMICE name (gmice.GMICES)
+        gmice.getGMICE(gmicename)
+    if len(sys.argv) > 3:
+        component = sys.argv[3] # ground motion component mode (COMPONENTS)
+        if component not in COMPONENTS:
+            raise ValueError(f'Unknown component mode {component}, choose from {", ".join(COMPONENTS)}')
     ###
     ### Input parameters ###
     ###
@@ -181,15 +607,24 @@ if __name__ == '__main__':
             exit()
     metadata = ob.read_inventory(invfile)
 
-    if not os.path.isdir(msdir) and not os.path.isfile(msfile):
-        print(f'miniseed directory {msdir} and file {msfile} does not exist!')
+    if bSDS:
+        # Shared archive: fetch only what the archive does not already hold
+        client = utils.getClient()
+        utils.downloadSDS(client, metadata, ev)
+        ms2mmi(ev, None, metadata, sds=utils.sdsroot)
+        exit()
+
+    # Download if there are no waveforms yet, or resume a download that did not complete
+    if os.path.isfile(utils.wfPending(evid)) or (not os.path.isdir(msdir) and not os.path.isfile(msfile)):
+        print(f'Downloading miniseed files to {msdir}')
+        client = utils.getClient()
         wffiles = utils.downloadWF(client, metadata, ev)
         if wffiles is None:
             print(f'Error retrieving miniseed files')
             exit()
 
     if os.path.isdir(msdir):
-        mslist = [os.path.join(msdir, ms) for ms in os.listdir(msdir)]
+        mslist = [os.path.join(msdir, ms) for ms in os.listdir(msdir) if not ms.endswith('.part')]
     else:
         mslist = [msfile]
 
@@ -0,0 +1,222 @@
+import os, sys
+from numpy import arange, array, cos, sin, radians, column_stack, meshgrid, where, isnan, nan, full, \
+        float32, sum as npsum, load, savez, bincount
+from numpy.lib.format import open_memmap
+from scipy.spatial import cKDTree
+
+import plots
+
+REARTH = 6371.0 # km
+
+def latlon2xyz(lat, lon):
+    '''
+    Convert geographic coordinates to cartesian coordinates (km) on a spherical earth, so that
+    euclidean (chord) distances can be used in a KD-tree. Chord and great circle distance differ by
+    less than 0.1% out to 500 km.
+    '''
+    lat = radians(lat)
+    lon = radians(lon)
+    return column_stack((REARTH * cos(lat) * cos(lon), REARTH * cos(lat) * sin(lon), REARTH * sin(lat)))
+
+def obsArrays(obs):
+    '''
+    Convert the exceedance_times dictionary (rdExceedanceTbl) to arrays
+    Returns:
+        stns: station names
+        lats, lons: station locations
+        mmilevels: MMI levels with exceedance times
+        etimes: array (station, MMI level) of exceedance times after origin, NaN if not exceeded
+        mmimax: maximum observed MMI per station
+    '''
+    stns = sorted([s for s in obs if obs[s]['location'] is not None])
+    mmilevels = sorted([m for m in obs[stns[0]] if m not in ['location', 'max']])
+    lats = array([obs[s]['location']['lat'] for s in stns])
+    lons = array([obs[s]['location']['lon'] for s in stns])
+    etimes = array([[nan if obs[s][m] is None else obs[s][m] for m in mmilevels] for s in stns])
+    mmimax = array([obs[s]['max'] for s in stns])
+    return stns, lats, lons, mmilevels, etimes, mmimax
+
+def buildInterpolator(obs):
+    '''
+    Create the KD-tree and station arrays used by interpObs
+    '''
+    stns, lats, lons, mmilevels, etimes, mmimax = obsArrays(obs)
+    return {'tree': cKDTree(latlon2xyz(lats, lons)), 'mmilevels': mmilevels,
+            'etimes': etimes, 'max': mmimax}
+
+def interpObs(interpolator, lats, lons, k=8, power=2., maxdist=None):
+    '''
+    Inverse-distance weighted interpolation of observed maximum MMI and MMI exceedance times from
+    the nearest k stations to target points.
+    The maximum MMI is interpolated first. A target point only has an exceedance time for a level
+    if the interpolated maximum MMI exceeds that level, in which case the time is the weighted
+    average over the neighbouring stations that also exceeded it.
+    Args:
+        interpolator: output of buildInterpolator
+        lats, lons: target point coordinates (1-D arrays)
+        k: number of nearest stations
+        power: inverse distance power, weights are 1/d^power
+        maxdist: optional distance (km) beyond which a target is left undefined (NaN)
+    Returns:
+        dictionary of arrays: 'max' and one entry per MMI level
+    '''
+    k = min(k, interpolator['tree'].n)
+    d, ind = interpolator['tree'].query(latlon2xyz(lats, lons), k=k)
+    if k == 1:
+        d = d[:, None]
+        ind = ind[:, None]
+    w = 1. / where(d < 0.001, 0.001, d)**power
+    if maxdist is not None:
+        w = where(d > maxdist, 0., w)
+    wsum = npsum(w, axis=1)
+    grid = {}
+    with_data = wsum > 0.
+    grid['max'] = where(with_data, npsum(w * interpolator['max'][ind], axis=1) / where(with_data, wsum, 1.), nan)
+    for im, m in enumerate(interpolator['mmilevels']):
+        et = interpolator['etimes'][ind, im]
+        wt = where(isnan(et), 0., w)
+        wtsum = npsum(wt, axis=1)
+        tm = npsum(wt * where(isnan(et), 0., et), axis=1) / where(wtsum > 0., wtsum, 1.)
+        grid[m] = where((grid['max'] > m) & (wtsum > 0.), tm, nan)
+    return grid
+
+def gridObs(obs, outdir, bounds=None, step=0.01, chunk=100, k=8, power=2., maxdist=None):
+    '''
+    Interpolate observed MMI and exceedance times onto a regular lat/lon grid, written to a
+    directory of .npy rasters (one per field, rows of latitude) that can be memory mapped.
+    The grid is computed in blocks of rows so that memory use is set by the chunk size.
+    Args:
+        obs: exceedance_times dictionary
+        outdir: output directory
+        bounds: xmin, xmax, ymin, ymax
+        step: grid spacing in degrees
+        chunk: number of grid rows per block
+    '''
+    if bounds is None:
+        bounds = [166.0, 179.0, -47.5, -34.0]
+    glons = arange(bounds[0], bounds[1] + step/2., step)
+    glats = arange(bounds[2], bounds[3] + step/2., step)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    savez(os.path.join(outdir, 'axes.npz'), lat=glats, lon=glons)
+    interpolator = buildInterpolator(obs)
+    fields = ['max'] + interpolator['mmilevels']
+    rasters = {}
+    for f in fields:
+        rasters[f] = open_memmap(os.path.join(outdir, f'{f}.npy'), mode='w+', dtype=float32,
+                                 shape=(len(glats), len(glons)))
+    for i0 in range(0, len(glats), chunk):
+        lon2d, lat2d = meshgrid(glons, glats[i0:i0+chunk])
+        grid = interpObs(interpolator, lat2d.ravel(), lon2d.ravel(), k=k, power=power, maxdist=maxdist)
+        for f in fields:
+            rasters[f][i0:i0+chunk] = grid[f].reshape(lat2d.shape)
+    for f in fields:
+        rasters[f].flush()
+    return outdir
+
+def gridAlerts(grid, alerts, adists, origin_time, outdir, chunk=100):
+    '''
+    First alert time rasters on the observation grid, written like gridObs (one .npy per alert MMI,
+    NaN if not alerted). A cell is alerted for an MMI by the first FinDer solution whose line source
+    is within the alert distance for its magnitude, with distances from
+    alert_times.nearestDistArray as in the raster mode of alert_times.py
+    Args:
+        grid: observation grid (rdObsGrid), for its lat and lon axes
+        alerts: alert list (alert_times.rdAlerts)
+        adists: alert distances (alert_times.rdAlertDists)
+    '''
+    import alert_times as at
+    glats = grid['lat']
+    glons = grid['lon']
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    savez(os.path.join(outdir, 'axes.npz'), lat=glats, lon=glons)
+    mmis = sorted(set([m for mag in adists for m in adists[mag]]))
+    rasters = {}
+    for m in mmis:
+        rasters[m] = open_memmap(os.path.join(outdir, f'{m}.npy'), mode='w+', dtype=float32,
+                                 shape=(len(glats), len(glons)))
+    for i0 in range(0, len(glats), chunk):
+        lon2d, lat2d = meshgrid(glons, glats[i0:i0+chunk])
+        first = {m: full(lat2d.shape, nan) for m in mmis}
+        fault = None
+        for alert in alerts:
+            # distances are only recomputed when the fault changes between solutions
+            if fault != (alert['alat'], alert['alon'], alert['zlat'], alert['zlon']):
+                fault = (alert['alat'], alert['alon'], alert['zlat'], alert['zlon'])
+                dist = at.nearestDistArray(lat2d, lon2d, *fault)
+            t = alert['tstr'] - origin_time
+            for m, d in adists[alert['mag']].items():
+                if d is not None:
+                    first[m][isnan(first[m]) & (d > dist)] = t
+        for m in mmis:
+            rasters[m][i0:i0+chunk] = first[m]
+    for m in mmis:
+        rasters[m].flush()
+    return outdir
+
+def rdObsGrid(outdir):
+    '''
+    Read (memory mapped) the rasters written by gridObs (or gridAlerts)
+    Returns:
+        grid: dictionary of 2-D arrays, with entries for 'lat' and 'lon' axes, 'max' and MMI levels
+    '''
+    axes = load(os.path.join(outdir, 'axes.npz'))
+    grid = {'lat': axes['lat'], 'lon': axes['lon']}
+    for f in os.listdir(outdir):
+        if not f.endswith('.npy'):
+            continue
+        key = f[:-4]
+        grid[key if key == 'max' else float(key)] = load(os.path.join(outdir, f), mmap_mode='r')
+    return grid
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    step = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01 # Grid spacing (degrees)
+    bAlerts = len(sys.argv) > 8 # categorise the grid against the alerts of a FinDer author
+    if bAlerts:
+        fd_evid = sys.argv[3] # FinDer event ID
+        author = sys.argv[4] # FinDer pipeline author
+        adistfile = sys.argv[5] # Alert distance file, or GMICE name
+        mag_w = float(sys.argv[6]) # Alert magnitude threshold
+        latency = float(sys.argv[7]) # Added latency for alerts
+        mmi_tw = float(sys.argv[8]) # Target MMI to provide warning for
+    ###
+    ### Input parameters ###
+    ###
+
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    if not os.path.isfile(ofname):
+        print(f'Cannot create observation grid as file {ofname} is missing')
+        exit()
+    obs = plots.rdExceedanceTbl(ofname)
+    gdir = gridObs(obs, os.path.join(evid, f'{evid}_obsgrid'), step=step)
+
+    if bAlerts:
+        import obspy as ob
+        import alert_times as at
+        alertfile = os.path.join(evid, f'{fd_evid}.xml')
+        evfile = os.path.join(evid, f'{evid}.xml')
+        for fname in [alertfile, evfile]:
+            if not os.path.isfile(fname):
+                print(f'Cannot categorise the grid as file {fname} is missing')
+                exit()
+        ev = ob.read_events(evfile, format='QUAKEML')[0]
+        grid = rdObsGrid(gdir)
+        if mmi_tw not in grid:
+            print(f'Cannot categorise the grid as MMI {mmi_tw} is not an observed level')
+            exit()
+        alerts = at.rdAlerts(alertfile, author, mag_w, latency)
+        adir = gridAlerts(grid, alerts, at.rdAlertDists(adistfile), ev.preferred_origin().time,
+                          os.path.join(evid, f'{evid}_alertgrid_{author}_{mag_w:.1f}_{latency:.0f}'))
+        alert_cats = plots.sortGridCategories(grid, rdObsGrid(adir), mmi_tw)
+        # Cell counts per category, over the cells with interpolated observations
+        covered = ~isnan(grid['max'])
+        with open(os.path.join(evid, f'{evid}_gridcats_{author}_{mag_w:.1f}_{latency:.0f}_mmitw-{mmi_tw}.dat'), 'w') as fout:
+            fout.write('# mmi_a ' + ' '.join(plots.CATEGORIES) + '\n')
+            for mmi_a in sorted(alert_cats):
+                counts = bincount(alert_cats[mmi_a][covered], minlength=len(plots.CATEGORIES))
+                fout.write(f'{mmi_a} ' + ' '.join([str(n) for n in counts]) + '\n')
@@ -1,20 +1,33 @@
 import sys
 import os
-from obspy import read_events
-from numpy import arange, histogram, cumsum, flip
-import matplotlib as mpl
-from matplotlib.pyplot import cm
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-import cartopy
-import cartopy.crs as ccrs
-import alert_times as at
+from numpy import arange, histogram, cumsum, flip, load, median
+import event_model as em
+import catalogue
+from event_model import CATEGORIES, categoriseArrays
 
 bTitles = False
 bInsets = True
 
+mpl = cm = plt = inset_axes = cartopy = ccrs = None # plotting stack, imported on first use (loadPlotting)
+
+def loadPlotting():
+    '''
+    Import matplotlib and cartopy on first use, so that scripts using only the table readers and
+    categories (and compute-only steps) do not pay for the plotting stack
+    '''
+    global mpl, cm, plt, inset_axes, cartopy, ccrs
+    if plt is not None:
+        return
+    import matplotlib as mpl
+    from matplotlib.pyplot import cm
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+    import cartopy
+    import cartopy.crs as ccrs
+    return
+
 def addBasemap(ax, bounds = None):
+    loadPlotting()
     if bounds == None:
         bounds = [166.0, 179.0, -47.5, -34.0]
     ax.set_extent(bounds, crs=ccrs.PlateCarree())
@@ -30,6 +43,7 @@ def setBasemap(bounds = None):
     Returns:
         fig, axes, proj: figure, axis and projection 
     '''
+    loadPlotting()
     fig, ax = plt.subplots(figsize=(5,5),
                            subplot_kw={
                                "projection": ccrs.Mercator()})
@@ -43,6 +57,7 @@ def plotObsMaps(evid, obs, zoom=False):
     '''
     Plot observation maps, observed MMI
     '''
+    loadPlotting()
     if zoom:
         # Zoom map to event
         import eew_utils as utils
@@ -73,10 +88,32 @@ def plotObsMaps(evid, obs, zoom=False):
     plt.close()
     return
 
-def plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, zoom=False):
+def plotPredMap(evid, fname, obs=None):
+    '''
+    Plot the predicted MMI raster for the last FinDer solution (alert_times.py with a raster
+    spacing), optionally with stations coloured by maximum observed MMI on the same scale
+    '''
+    loadPlotting()
+    pred = load(fname)
+    fig, ax, proj, map_proj = setBasemap(bounds=[pred['lon'][0], pred['lon'][-1], pred['lat'][0], pred['lat'][-1]])
+    cb = ax.pcolormesh(pred['lon'], pred['lat'], pred['pred'], transform=proj, cmap='jet',
+            vmin=2., vmax=9., shading='nearest', zorder=1)
+    if obs is not None:
+        ax.scatter([obs[x]['location']['lon'] for x in obs], 
+                [obs[x]['location']['lat'] for x in obs], 
+                c=[obs[x]['max'] for x in obs], vmin=2., vmax=9.,
+                transform=proj, cmap='jet', lw=0.5, edgecolor='k', zorder=3)
+    cbar = fig.colorbar(cb, ax=ax)
+    cbar.set_label('predicted MMI')
+    fig.savefig(fname.replace('.npz', '.png'), bbox_inches='tight')
+    plt.close()
+    return
+
+def plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, zoom=False, tag=''):
     '''
     Plot alert maps
     '''
+    loadPlotting()
     if zoom:
         # Zoom map to event
         import eew_utils as utils
@@ -132,7 +169,7 @@ def plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, z
         ax.scatter([alerts[x]['location'][1] for x in alert_cats[mmi_a]['TN']], 
                 [alerts[x]['location'][0] for x in alert_cats[mmi_a]['TN']], 
                 transform=proj, c='white', lw=0.5, edgecolor='k', zorder=3, label='TN', s=15)
-        if bInsets:
+        if bInsets and fdsol is not None:
             alat = fdsol['fcoords'][0][0]
             alon = fdsol['fcoords'][0][1]
             zlat = fdsol['fcoords'][-1][0]
@@ -179,16 +216,17 @@ def plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, z
         cbar.ax.set_yticklabels(['1', '2', '', '', '5', '', '', '', '', '10', '20', '30', '40'])
         cbar.set_label('warning time (s)')
         if zoom:
-            fig.savefig(os.path.join(evid, f'{evid}_mmi{mmi_a}_map-zoom.png'), bbox_inches='tight')
+            fig.savefig(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}_map-zoom.png'), bbox_inches='tight')
         else:
-            fig.savefig(os.path.join(evid, f'{evid}_mmi{mmi_a}_map.png'), bbox_inches='tight')
+            fig.savefig(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}_map.png'), bbox_inches='tight')
     plt.close()
     return
 
-def plotScatterMMI(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
+def plotScatterMMI(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag=''):
     '''
     Plot scatter plots, observed vs predicted MMI
     '''
+    loadPlotting()
     win = cm.winter
     win.set_over('cyan')
     win.set_under('b')
@@ -228,14 +266,15 @@ def plotScatterMMI(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
         ax.set_xlabel('Observed MMI')
         ax.set_ylabel('Predicted MMI')
         ax.grid()
-        fig.savefig(os.path.join(evid, f'{evid}_mmi{mmi_a}_scatter.png'))
+        fig.savefig(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}_scatter.png'))
     plt.close()
     return
 
-def plotScatterWarningTimeDist(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
+def plotScatterWarningTimeDist(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag=''):
     '''
     Scatter plot of warning time against distance
     '''
+    loadPlotting()
     # MMI bounds
     mmimin = 2.
     mmimax = 10.
@@ -280,14 +319,15 @@ def plotScatterWarningTimeDist(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
         ax.set_ylabel('warning time (s)')
         ax.set_xlabel('distance (km)')
         ax.grid()
-        fig.savefig(os.path.join(evid, f'{evid}_mmi{mmi_a}_timedist.png'), bbox_inches='tight')
+        fig.savefig(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}_timedist.png'), bbox_inches='tight')
     plt.close()
     return
 
-def plotWarningTimeCDF(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
+def plotWarningTimeCDF(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag=''):
     '''
     Plot CDF of warning times
     '''
+    loadPlotting()
     # Warning time bounds
     wtmin = -100.
     wtmax = 300.
@@ -338,7 +378,65 @@ def plotWarningTimeCDF(evid, mmi_tw, mag_w, alert_cats, alerts, obs):
         dnorm = mpl.colors.BoundaryNorm([2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0], cmap.N)
         cbar = fig.colorbar(mpl.cm.ScalarMappable(norm=dnorm, cmap=cmap), ticks=range(2,11), ax=ax)
         cbar.set_label('Maximum observed MMI')
-        fig.savefig(os.path.join(evid, f'{evid}_mmi{mmi_a}_cdf.png'), bbox_inches='tight')
+        fig.savefig(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}_cdf.png'), bbox_inches='tight')
+    plt.close()
+    return
+
+def plotLatencyCurves(evid, mmi_tw, mag_w, latencies, allcurves, tag=''):
+    '''
+    Plot TPT and TPU counts and median TPT warning time against latency (metrics.latencyCurves),
+    one line per alert MMI
+    '''
+    loadPlotting()
+    mmimin = 2.
+    mmimax = 10.
+    cmap = plt.get_cmap('jet')
+    norm = mpl.colors.Normalize(vmin=mmimin, vmax=mmimax)
+    scalarMap = cm.ScalarMappable(norm=norm, cmap=cmap)
+    fig, ax = plt.subplots(1, 2, figsize=(10,5))
+    for mmi_a in allcurves:
+        curves = allcurves[mmi_a]
+        if curves['TPT'][0] + curves['TPU'][0] == 0:
+            continue
+        ax[0].plot(latencies, curves['TPT'], c=scalarMap.to_rgba(mmi_a), label=f'MMI_alert {mmi_a}')
+        ax[0].plot(latencies, curves['TPU'], c=scalarMap.to_rgba(mmi_a), ls='--')
+        if 'ETPT' in curves:
+            ax[0].plot(latencies, curves['ETPT'], c=scalarMap.to_rgba(mmi_a), ls=':')
+        ax[1].plot(latencies, curves['q0.5'], c=scalarMap.to_rgba(mmi_a))
+    if bTitles:
+        ax[0].set_title(f'TP timely (solid) and untimely (dashed)\nMag: {mag_w}, MMI_tw: {mmi_tw}')
+        ax[1].set_title(f'Median warning time to MMI_tw\nMag: {mag_w}, MMI_tw: {mmi_tw}')
+        fig.legend(loc='upper right')
+    ax[0].set_xlabel('Latency (s)')
+    ax[0].set_ylabel('Number of stations')
+    ax[1].set_xlabel('Latency (s)')
+    ax[1].set_ylabel('Median warning time (s)')
+    for a in ax:
+        a.grid(ls=':')
+    fig.savefig(os.path.join(evid, f'{evid}{tag}_latency_{mag_w:.1f}_mmitw-{mmi_tw}.png'), bbox_inches='tight')
+    plt.close()
+    return
+
+def plotMagSweep(evid, mmi_tw, latency, mags, counts, tag=''):
+    '''
+    Plot category counts against alert magnitude threshold (sweep.magSweep), one panel per alert MMI
+    '''
+    loadPlotting()
+    cols = {'TPT': 'b', 'TPL': 'yellow', 'TPU': 'black', 'FP': 'orange', 'FN': 'red', 'TN': 'grey'}
+    mmi_alerts = [m for m in counts if counts[m][:, :5].sum() > 0]
+    if len(mmi_alerts) == 0:
+        return
+    fig, ax = plt.subplots(len(mmi_alerts), 1, figsize=(5, 2*len(mmi_alerts)), sharex=True, squeeze=False)
+    for i, mmi_a in enumerate(mmi_alerts):
+        for j, cat in enumerate(CATEGORIES):
+            ax[i, 0].plot(mags, counts[mmi_a][:, j], c=cols[cat], label=cat)
+        ax[i, 0].set_ylabel(f'MMI_alert {mmi_a}')
+        ax[i, 0].grid(ls=':')
+    if bTitles:
+        ax[0, 0].set_title(f'Latency: {latency}s, MMI_tw: {mmi_tw}')
+    ax[0, 0].legend(loc='upper right', fontsize='small')
+    ax[-1, 0].set_xlabel('Alert magnitude threshold')
+    fig.savefig(os.path.join(evid, f'{evid}{tag}_magsweep_{latency:.0f}_mmitw-{mmi_tw}.png'), bbox_inches='tight')
     plt.close()
     return
 
@@ -360,56 +458,69 @@ def rdExceedanceTbl(fname):
             obs[stn] = lstr
     return obs
 
-def sortCategories(evid, obs, alerts, mmi_tw = 5.0):
+def sortCategories(evid, model, mmi_tw = 5.0, tag = ''):
     '''
     Sort results into categories: TP, FP, FN, TN. Account for untimely TP and TP with low ground motion
-    Plot 
+    model: event model with the alerts joined (event_model.rdEvent)
+    tag: added to the table name after evid, e.g. _<author> when comparing FinDer authors
     '''
-    mmi_alerts = sorted(set([mmi for stn in alerts for mmi in alerts[stn] if stn != 'times' and mmi not in ['location', 'dist', 'pred', 'epidist']]))
+    stations, cats = em.categories(model, mmi_tw)
+    levels = [float(m) for m in model['levels']]
+    obs_tw = model['exc'][stations, levels.index(mmi_tw)]
+    amms = [float(m) for m in model['amms']]
     alert_cats = {}
-    for mmi_a in mmi_alerts:
-        if mmi_a == 'pred':
-            continue
-        fout = open(os.path.join(evid, f'{evid}_mmi{mmi_a}.dat'), 'w')
+    for mmi_a in cats:
+        alert_a = model['alert'][stations, amms.index(mmi_a)]
         alert_cats[mmi_a] = {}
-        for cat in ['FP', 'TPU', 'TPT', 'TPL', 'FN', 'TN']:
+        for cat in CATEGORIES:
             alert_cats[mmi_a][cat] = []
-        for stn in obs:
-            # MMI observed to exceed mmi_a at site
-            if obs[stn][mmi_a] is not None:
-                # mmi_a alerted
-                if mmi_a in alerts[stn]:
-                    # TP
-                    # TP and strong (mmi > mmi_tw)
-                    if obs[stn][mmi_tw] is not None:
-                        # Alert later than MMI strong (mmi_tw)
-                        if alerts[stn][mmi_a] > obs[stn][mmi_tw]:
-                            fout.write(f'{stn} TP untimely\n')
-                            alert_cats[mmi_a]['TPU'].append(stn)
-                        # Alert earlier than MMI strong (mmi_tw)
-                        else:
-                            wt = obs[stn][mmi_tw]-alerts[stn][mmi_a]
-                            fout.write(f'{stn} TP with warning time {wt}\n')
-                            alert_cats[mmi_a]['TPT'].append(stn)
-                    # TP but weak (mmi < mmi_tw)
-                    else:
-                        fout.write(f'{stn} TP but light (MMI < {mmi_tw})\n')
-                        alert_cats[mmi_a]['TPL'].append(stn)
-                # mmi_a not alerted
-                else:
-                    fout.write(f'{stn} FN\n')
-                    alert_cats[mmi_a]['FN'].append(stn)
-            # MMI not observed to exceed mmi_a at site
-            else:
-                # mmi_a alerted but mmi_a never reached
-                if mmi_a in alerts[stn]:
-                    fout.write(f'{stn} FP\n')
-                    alert_cats[mmi_a]['FP'].append(stn)
-                # mmi_a not alerted and mmi_a never reached
+        with open(os.path.join(evid, f'{evid}{tag}_mmi{mmi_a}.dat'), 'w') as fout:
+            for i, c in enumerate(cats[mmi_a]):
+                stn = str(model['stations'][stations[i]])
+                cat = CATEGORIES[c]
+                alert_cats[mmi_a][cat].append(stn)
+                if cat == 'TPU':
+                    fout.write(f'{stn} TP untimely\n')
+                elif cat == 'TPT':
+                    fout.write(f'{stn} TP with warning time {obs_tw[i]-alert_a[i]}\n')
+                elif cat == 'TPL':
+                    fout.write(f'{stn} TP but light (MMI < {mmi_tw})\n')
                 else:
-                    fout.write(f'{stn} TN\n')
-                    alert_cats[mmi_a]['TN'].append(stn)
-        fout.close()
+                    fout.write(f'{stn} {cat}\n')
+    return alert_cats
+
+def wrAuthorComparison(fname, outcomes):
+    '''
+    Write the category counts and median TPT warning time of each FinDer author side by side:
+    alert MMI then one row per author
+    outcomes: dictionary by author of (counts, wt_median) as recorded by catalogue.wrOutcome
+    '''
+    with open(fname, 'w') as fout:
+        fout.write('# mmi_a author ' + ' '.join(CATEGORIES) + ' wt_median\n')
+        for mmi_a in sorted(set([m for a in outcomes for m in outcomes[a][0]])):
+            for author, (counts, wt_median) in outcomes.items():
+                if mmi_a not in counts:
+                    continue
+                wt = wt_median.get(mmi_a)
+                fout.write(f'{mmi_a} {author} ' + ' '.join([str(counts[mmi_a][c]) for c in CATEGORIES]) +
+                           (' nan' if wt is None else f' {wt:.2f}') + '\n')
+    return
+
+def sortGridCategories(grid, alertgrid, mmi_tw = 5.0):
+    '''
+    Sort gridded results (see obs_grid.py) into categories
+    Args:
+        grid: observed exceedance time rasters, keyed by MMI (obs_grid.rdObsGrid)
+        alertgrid: first alert time rasters on the same grid, keyed by mmi_a, NaN if not alerted
+            (obs_grid.gridAlerts)
+    Returns:
+        alert_cats: dictionary of category rasters (indices into CATEGORIES) keyed by mmi_a
+    '''
+    alert_cats = {}
+    for mmi_a in alertgrid:
+        if mmi_a in ['lat', 'lon', 'max'] or mmi_a not in grid:
+            continue
+        alert_cats[mmi_a] = categoriseArrays(grid[mmi_a], grid[mmi_tw], alertgrid[mmi_a])
     return alert_cats
 
 if __name__ == '__main__':
@@ -421,30 +532,25 @@ if __name__ == '__main__':
     mag_w = float(sys.argv[3]) # Magnitude to issue warnings for
     latency = float(sys.argv[4]) # Delivery latency
     fd_evid = sys.argv[5] # FinDer event ID
+    authors = sys.argv[6].split(',') if len(sys.argv) > 6 else ['scfinder'] # FinDer pipeline author, or comma separated authors to compare
     ###
     ### Input parameters ###
     ###
     print(f'{evid} {mmi_tw} {mag_w} {latency}')
+    import alert_times as at
 
     ofname = os.path.join(evid, 'exceedance_times.tbl')
     if not os.path.isfile(ofname):
         print(f'Cannot create plots as file {ofname} is missing')
         exit()
 
-    afname = os.path.join(evid, f'alert_times_{mag_w:.1f}_{latency:.0f}.tbl')
-    if not os.path.isfile(afname):
-        print(f'Cannot create plots as file {afname} is missing')
-        exit()
-
-    obs = rdExceedanceTbl(ofname)
-    if not os.path.isfile(os.path.join(evid, f'{evid}_map-obs.png')):
-        plotObsMaps(evid, obs)
-    if not os.path.isfile(os.path.join(evid, f'{evid}_map-obs-zoom.png')):
-        plotObsMaps(evid, obs, zoom=True)
-    alerts = rdAlertTbl(afname)
-    alert_cats = sortCategories(evid, obs, alerts, mmi_tw)
+    afnames = {author: at.alertFile(evid, mag_w, latency, None if len(authors) == 1 else author) for author in authors}
+    for afname in afnames.values():
+        if not os.path.isfile(afname):
+            print(f'Cannot create plots as file {afname} is missing')
+            exit()
 
-    fdsol = None
+    fdsols = []
     ev = None
     if bInsets:
         # FinDer
@@ -452,10 +558,8 @@ if __name__ == '__main__':
         if not os.path.isfile(alertfile):
             print(f'Error missing FinDer event with id {fd_evid}')
             bInsets = False
-        with open(alertfile, 'r') as fin:
-            txt = fin.read()
-        ret, fdsols, fdevent, lastt = at.scxml2fdsol(txt)
-        fdsol = sorted([f for f in fdsols if f['author'] == 'scfinder'], key=lambda d: d['vtime'], reverse=True)[0]
+        else:
+            ret, fdsols, fdevent, lastt = catalogue.rdFDSols(alertfile)
         # Catalog
         evfile = os.path.join(evid, f'{evid}.xml')
         if not os.path.isfile(evfile):
@@ -465,10 +569,39 @@ if __name__ == '__main__':
                 print(f'Error retrieving event with id {evid}')
                 exit()
             ev.write(evfile, format='QUAKEML')
+        from obspy import read_events
         ev = read_events(evfile, format='QUAKEML')[0]
-    plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev)
-    plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, zoom=True)
-    plotScatterMMI(evid, mmi_tw, mag_w, alert_cats, alerts, obs)
-    plotWarningTimeCDF(evid, mmi_tw, mag_w, alert_cats, alerts, obs)
-    plotScatterWarningTimeDist(evid, mmi_tw, mag_w, alert_cats, alerts, obs)
 
+    outcomes = {}
+    for author in authors:
+        tag = '' if len(authors) == 1 else f'_{author}'
+        afname = afnames[author]
+        model = em.rdEvent(evid, ofname, afname)
+        obs = em.toExceedanceDict(model)
+        # Observation maps are redrawn only if missing or older than the exceedance table
+        for zoom, f in [(False, f'{evid}_map-obs.png'), (True, f'{evid}_map-obs-zoom.png')]:
+            f = os.path.join(evid, f)
+            if not os.path.isfile(f) or os.path.getmtime(f) < os.path.getmtime(ofname):
+                plotObsMaps(evid, obs, zoom=zoom)
+        alerts = em.toAlertDict(model)
+        pfname = afname.replace('alert_times_', 'pred_mmi_').replace('.tbl', '.npz')
+        if os.path.isfile(pfname):
+            plotPredMap(evid, pfname, obs)
+        alert_cats = sortCategories(evid, model, mmi_tw, tag)
+        counts = {mmi_a: {cat: len(alert_cats[mmi_a][cat]) for cat in CATEGORIES} for mmi_a in alert_cats}
+        wt_median = {mmi_a: float(median([obs[s][mmi_tw]-alerts[s][mmi_a] for s in alert_cats[mmi_a]['TPT']]))
+                     for mmi_a in alert_cats if len(alert_cats[mmi_a]['TPT']) > 0}
+        catalogue.wrOutcome(evid, author, mag_w, latency, mmi_tw, counts, wt_median)
+        outcomes[author] = (counts, wt_median)
+
+        fdsol = None
+        if bInsets:
+            fdsol = sorted([f for f in fdsols if f['author'] == author], key=lambda d: d['vtime'], reverse=True)
+            fdsol = fdsol[0] if len(fdsol) > 0 else None
+        plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, tag=tag)
+        plotMaps(evid, mmi_tw, mag_w, latency, alert_cats, alerts, obs, fdsol, ev, zoom=True, tag=tag)
+        plotScatterMMI(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag)
+        plotWarningTimeCDF(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag)
+        plotScatterWarningTimeDist(evid, mmi_tw, mag_w, alert_cats, alerts, obs, tag)
+    if len(authors) > 1:
+        wrAuthorComparison(os.path.join(evid, f'{evid}_authors_{mag_w:.1f}_{latency:.0f}_mmitw-{mmi_tw}.dat'), outcomes)
@@ -0,0 +1,185 @@
+import os, sys
+import time
+import asyncio
+from numpy import array, full, nan, isnan, cos, radians, bincount, mean
+
+import alert_times as at
+import plots
+
+async def waitUntil(clock, t):
+    '''
+    Sleep until simulated time t (s after origin) on the replay clock
+    '''
+    wait = (t - clock['tstart']) / clock['speed'] - (asyncio.get_running_loop().time() - clock['wstart'])
+    if wait > 0.:
+        await asyncio.sleep(wait)
+    return
+
+async def fdProducer(clock, queue, alerts, origin_time, latency):
+    '''
+    Deliver FinDer solutions at their creation time plus latency
+    '''
+    for alert in sorted(alerts, key=lambda a: a['tstr']):
+        t = alert['tstr'] - origin_time + latency
+        await waitUntil(clock, t)
+        await queue.put(('fd', t, alert))
+    await queue.put(('fd', None, None))
+    return
+
+async def obsProducer(clock, queue, obs, mmilevels):
+    '''
+    Deliver station exceedances at their observed times
+    '''
+    exc = sorted([(obs[s][m], s, m) for s in obs for m in mmilevels if obs[s].get(m) is not None])
+    for t, stn, m in exc:
+        await waitUntil(clock, t)
+        await queue.put(('obs', t, (stn, m)))
+    await queue.put(('obs', None, None))
+    return
+
+def initState(sites, adists):
+    '''
+    Alert state for the replay: site arrays and first alert time per site and MMI (NaN if not alerted)
+    '''
+    names = list(sites)
+    mmis = sorted(set([m for mag in adists for m in adists[mag] if adists[mag][m] is not None]))
+    return {'names': names,
+            'index': {s: i for i, s in enumerate(names)},
+            'lat': array([sites[s][0] for s in names]),
+            'lon': array([sites[s][1] for s in names]),
+            'mmis': mmis,
+            'first': full((len(names), len(mmis)), nan),
+            'latency': []}
+
+def updateAlerts(state, alert, adists, t):
+    '''
+    Apply one FinDer solution to the alert state, touching only sites whose status can change:
+    sites not yet alerted at every level, inside a box of the largest alert distance for this
+    magnitude around the fault. The candidates get the same geodesic fault distances as
+    alert_times.py (computeNearestDist), so the replay alerts match the alert table
+    '''
+    tstart = time.perf_counter()
+    adist = adists[alert['mag']]
+    maxdist = max([d for d in adist.values() if d is not None])
+    padlat = maxdist / 110.574 # shortest degree of latitude (WGS84), so the box is never too small
+    padlon = padlat / max(cos(radians(max(abs(alert['alat']), abs(alert['zlat'])) + padlat)), 0.1)
+    cand = isnan(state['first']).any(axis=1) & \
+            (state['lat'] > min(alert['alat'], alert['zlat']) - padlat) & \
+            (state['lat'] < max(alert['alat'], alert['zlat']) + padlat) & \
+            (state['lon'] > min(alert['alon'], alert['zlon']) - padlon) & \
+            (state['lon'] < max(alert['alon'], alert['zlon']) + padlon)
+    ind = cand.nonzero()[0]
+    if len(ind) > 0:
+        dist = array([at.computeNearestDist(state['lat'][i], state['lon'][i],
+                alert['alat'], alert['alon'], alert['zlat'], alert['zlon']) for i in ind])
+        for j, mmi in enumerate(state['mmis']):
+            if adist.get(mmi) is None:
+                continue
+            new = isnan(state['first'][ind, j]) & (adist[mmi] > dist)
+            state['first'][ind[new], j] = t
+    state['latency'].append((time.perf_counter() - tstart, len(ind)))
+    return
+
+async def consumer(queue, state, adists, mmi_tw, tally):
+    '''
+    Update alert state per FinDer solution and score each station exceedance of mmi_tw against
+    the alerts issued so far
+    '''
+    done = 0
+    while done < 2:
+        kind, t, item = await queue.get()
+        if t is None:
+            done += 1
+            continue
+        if kind == 'fd':
+            updateAlerts(state, item, adists, t)
+            continue
+        stn, m = item
+        if m != mmi_tw or stn not in state['index']:
+            continue
+        i = state['index'][stn]
+        for j, mmi_a in enumerate(state['mmis']):
+            tally.setdefault(mmi_a, {'timely': 0, 'late': 0})
+            if not isnan(state['first'][i, j]) and state['first'][i, j] <= t:
+                tally[mmi_a]['timely'] += 1
+            else:
+                tally[mmi_a]['late'] += 1
+    return
+
+async def replay(ev, alerts, sites, adists, obs, latency=0., mmi_tw=5.0, speed=100.):
+    '''
+    Replay an event on a single asyncio timeline: FinDer solutions arrive at their creation time
+    plus latency and station exceedances at their observed times, both scaled by speed
+    Returns:
+        state: final alert state
+        tally: live count per alert MMI of mmi_tw exceedances with (timely) and without (late)
+        an earlier alert
+    '''
+    origin_time = ev.preferred_origin().time
+    mmilevels = sorted([m for s in obs for m in obs[s] if m not in ['location', 'max']])
+    mmilevels = sorted(set(mmilevels))
+    state = initState(sites, adists)
+    tally = {}
+    times = [a['tstr'] - origin_time + latency for a in alerts] + \
+            [obs[s][m] for s in obs for m in mmilevels if obs[s].get(m) is not None]
+    loop = asyncio.get_running_loop()
+    clock = {'tstart': min(times) if len(times) > 0 else 0., 'wstart': loop.time(), 'speed': speed}
+    queue = asyncio.Queue()
+    await asyncio.gather(fdProducer(clock, queue, alerts, origin_time, latency),
+                         obsProducer(clock, queue, obs, mmilevels),
+                         consumer(queue, state, adists, mmi_tw, tally))
+    state['wall'] = loop.time() - clock['wstart']
+    state['span'] = max(times) - min(times) if len(times) > 0 else 0.
+    return state, tally
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    fd_evid = sys.argv[2] # FinDer event ID
+    author = sys.argv[3] # FinDer pipeline author
+    adistfile = sys.argv[4] # Alert distance file, or GMICE name
+    mag_w = float(sys.argv[5]) # Alert magnitude threshold
+    latency = float(sys.argv[6]) # Added latency for alerts
+    mmi_tw = float(sys.argv[7]) # Target MMI to provide warning for
+    speed = float(sys.argv[8]) if len(sys.argv) > 8 else 100. # Replay speed relative to real time
+    ###
+    ### Input parameters ###
+    ###
+    import obspy as ob
+
+    alertfile = os.path.join(evid, f'{fd_evid}.xml')
+    evfile = os.path.join(evid, f'{evid}.xml')
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    for fname in [alertfile, evfile, ofname]:
+        if not os.path.isfile(fname):
+            print(f'Cannot replay as file {fname} is missing')
+            exit()
+    ev = ob.read_events(evfile, format='QUAKEML')[0]
+    alerts = at.rdAlerts(alertfile, author, mag_w, 0.)
+    sites = at.rdSites(os.path.join(evid, f'{evid}_inventory.xml'))
+    adists = at.rdAlertDists(adistfile)
+    obs = plots.rdExceedanceTbl(ofname)
+
+    state, tally = asyncio.run(replay(ev, alerts, sites, adists, obs, latency, mmi_tw, speed))
+
+    lat = array([l[0] for l in state['latency']])
+    ntouched = array([l[1] for l in state['latency']])
+    print(f'Replayed {state["span"]:.1f}s of event in {state["wall"]:.2f}s ({speed}x)')
+    if len(lat) > 0:
+        print(f'{len(lat)} FinDer updates: compute latency mean {mean(lat)*1000.:.3f} ms, max {lat.max()*1000.:.3f} ms, '
+              f'mean {mean(ntouched):.0f} of {len(state["names"])} sites touched per update')
+    for mmi_a in sorted(tally):
+        print(f'MMI_alert {mmi_a}: {tally[mmi_a]["timely"]} timely, {tally[mmi_a]["late"]} late or missed at MMI_tw {mmi_tw}')
+    # Final categories, as sortCategories
+    with open(os.path.join(evid, f'replay_{mag_w:.1f}_{latency:.0f}.txt'), 'w') as fout:
+        stns = [s for s in obs if s in state['index']]
+        ind = array([state['index'][s] for s in stns], dtype=int)
+        obs_tw = array([nan if obs[s].get(mmi_tw) is None else obs[s][mmi_tw] for s in stns])
+        for j, mmi_a in enumerate(state['mmis']):
+            obs_a = array([nan if obs[s].get(mmi_a) is None else obs[s][mmi_a] for s in stns])
+            counts = bincount(plots.categoriseArrays(obs_a, obs_tw, state['first'][ind, j]), minlength=len(plots.CATEGORIES))
+            fout.write(f'{mmi_a} ' + ' '.join([f'{c}={n}' for c, n in zip(plots.CATEGORIES, counts)]) + '\n')
+        for l, n in state['latency']:
+            fout.write(f'latency {l} {n}\n')
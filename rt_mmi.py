@@ -0,0 +1,209 @@
+import os, sys
+import time
+import obspy as ob
+from numpy import log10, absolute, where, arange, concatenate, cumsum, zeros, float64, nonzero
+from scipy.signal import butter, sosfilt
+
+import ms2mmi
+import gmice
+
+packetlen = 1. # seconds of data per replayed packet (SeedLink records are ~1-10 s)
+
+def initEngine(ev, metadata, callback=None):
+    '''
+    Create the state for the streaming MMI exceedance engine
+    Args:
+        ev: obspy Event object
+        metadata: obspy inventory
+        callback: function(event) called for each new station exceedance, where event is a dictionary
+            of station, mmi, time (s after origin) and latency (s, compute time from receiving the
+            packet to the exceedance)
+    Returns:
+        engine: dictionary of engine state, with channel state ('chans') and the per-station
+        reduction ('stations') in the exceedance_times format
+    '''
+    return {'origin_time': ev.preferred_origin().time,
+            'elat': ev.preferred_origin().latitude,
+            'elon': ev.preferred_origin().longitude,
+            'metadata': metadata,
+            'mmilevels': arange(2.5, 9, 0.5),
+            'callback': callback,
+            'chans': {},
+            'stations': {},
+            'events': []}
+
+def initChannel(engine, tr):
+    '''
+    Create the filter and peak state for a channel on its first packet.
+    Returns None for channels that are not used (location, missing metadata), as in ms2mmi.
+    '''
+    if tr.stats.location not in ms2mmi.locations:
+        return None
+    try:
+        sdict = engine['metadata'].get_channel_metadata(tr.get_id())
+        sens = engine['metadata'].get_response(tr.get_id(), tr.stats.starttime).instrument_sensitivity.value
+    except:
+        print(f'Failed to find metadata for {tr.get_id()}')
+        return None
+    dist, az = ms2mmi.calcdistaz(sdict['latitude'], sdict['longitude'], engine['elat'], engine['elon'])
+    sos = butter(4, ms2mmi.hpfreq / (0.5 * tr.stats.sampling_rate), btype='highpass', output='sos')
+    return {'location': {'lat': sdict['latitude'], 'lon': sdict['longitude'], 'epidist': dist},
+            'gain': 100. / sens, # convert m/s/s to cm/s/s
+            'offset': None,
+            'sos': sos,
+            'delta': tr.stats.delta,
+            'next': None,
+            'zi': zeros((sos.shape[0], 2)),
+            'zi2': zeros((sos.shape[0], 2)),
+            'last': None,
+            'vsum': 0.,
+            'max': 0.,
+            'exc': {m: None for m in engine['mmilevels']}}
+
+def resetChannel(ch):
+    '''
+    Restart the filters of a channel after a gap, keeping its peaks and exceedance times
+    '''
+    ch['zi'][:] = 0.
+    ch['zi2'][:] = 0.
+    ch['last'] = None
+    ch['vsum'] = 0.
+    return
+
+def processPacket(engine, tr):
+    '''
+    Update the engine with one waveform packet (obspy Trace). Packets for a channel must arrive in
+    time order. Filter state is carried between packets, so the acceleration and velocity are those
+    of ms2mmi computed causally; the baseline is the mean of the first packet (pre-event noise)
+    rather than of the whole record, and broadband acceleration uses a backward difference.
+    Returns:
+        events: list of new station exceedance events (also passed to the engine callback)
+    '''
+    tstart = time.perf_counter()
+    stub = tr.get_id()
+    if stub not in engine['chans']:
+        engine['chans'][stub] = initChannel(engine, tr)
+    ch = engine['chans'][stub]
+    if ch is None or tr.stats.npts == 0:
+        return []
+    if ch['next'] is not None and abs(tr.stats.starttime - ch['next']) > 1.5 * ch['delta']:
+        resetChannel(ch)
+    ch['next'] = tr.stats.endtime + ch['delta']
+    data = tr.data.astype(float64)
+    if ch['offset'] is None:
+        ch['offset'] = data.mean()
+    data -= ch['offset']
+    data *= ch['gain']
+    data, ch['zi'] = sosfilt(ch['sos'], data, zi=ch['zi'])
+    prev = concatenate(([data[0] if ch['last'] is None else ch['last']], data[:-1]))
+    ch['last'] = data[-1]
+    # ground motion types
+    if tr.stats.channel[1] == 'H': # assuming HH? = broadband and HN? = strong motion
+        vel = data
+        acc = (data - prev) / ch['delta']
+    else:
+        acc = data
+        vel = ch['vsum'] + cumsum((prev + data) * (ch['delta'] / 2.))
+        ch['vsum'] = vel[-1]
+        vel, ch['zi2'] = sosfilt(ch['sos'], vel, zi=ch['zi2'])
+    acc = absolute(acc)
+    vel = absolute(vel)
+    mmi = gmice.gm2mmiArray(log10(where(acc > 0, acc, 0.0001)), log10(where(vel > 0, vel, 0.0001)), ms2mmi.gmicename, ms2mmi.bLUT)
+    ch['max'] = max(ch['max'], mmi.max())
+    stn = '.'.join(stub.split('.')[:2])
+    if stn not in engine['stations']:
+        engine['stations'][stn] = {m: None for m in engine['mmilevels']}
+        engine['stations'][stn]['location'] = ch['location']
+        engine['stations'][stn]['max'] = ch['max']
+    sexc = engine['stations'][stn]
+    sexc['max'] = max(sexc['max'], ch['max'])
+    events = []
+    for m in engine['mmilevels']:
+        if ch['exc'][m] is not None:
+            continue
+        ind = nonzero(mmi > m)[0]
+        if len(ind) == 0:
+            break
+        ch['exc'][m] = tr.stats.starttime + (ch['delta'] * ind[0]) - engine['origin_time']
+        if sexc[m] is None:
+            sexc[m] = ch['exc'][m]
+            events.append({'station': stn, 'mmi': m, 'time': sexc[m], 'latency': time.perf_counter() - tstart})
+        elif ch['exc'][m] < sexc[m]:
+            # Earlier exceedance on another channel of the station arriving late
+            sexc[m] = ch['exc'][m]
+    for event in events:
+        engine['events'].append(event)
+        if engine['callback'] is not None:
+            engine['callback'](event)
+    return events
+
+def replayMS(mslist, speed=None):
+    '''
+    Local stand-in for a SeedLink server: replay miniseed files as packets of packetlen seconds,
+    in the order their last samples would be recorded
+    Args:
+        mslist: list of miniseed files
+        speed: replay speed relative to real time (None for as fast as possible)
+    Yields:
+        packet: obspy Trace
+    '''
+    packets = []
+    for ms in sorted(mslist):
+        for tr in ob.read(ms):
+            t = tr.stats.starttime
+            while t <= tr.stats.endtime:
+                packets.append(tr.slice(t, t + packetlen - tr.stats.delta / 2.))
+                t += packetlen
+    packets.sort(key=lambda p: p.stats.endtime)
+    if len(packets) == 0:
+        return
+    tref = packets[0].stats.endtime
+    wref = time.time()
+    for p in packets:
+        if speed is not None:
+            wait = (p.stats.endtime - tref) / speed - (time.time() - wref)
+            if wait > 0.:
+                time.sleep(wait)
+        yield p
+
+def wrExceedanceTbl(engine, fname):
+    '''
+    Write the station exceedance times in the exceedance_times.tbl format
+    '''
+    with open(fname, 'w') as fout:
+        for stn in sorted(engine['stations']):
+            fout.write(f'{stn} {engine["stations"][stn]}\n')
+    return
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None # Replay speed, relative to real time
+    ###
+    ### Input parameters ###
+    ###
+
+    evfile = os.path.join(evid, f'{evid}.xml')
+    invfile = os.path.join(evid, f'{evid}_inventory.xml')
+    msdir = os.path.join(evid, f'{evid}_ms')
+    if not os.path.isfile(evfile) or not os.path.isfile(invfile) or not os.path.isdir(msdir):
+        print(f'Event, inventory or miniseed directory missing for {evid}, run ms2mmi.py first')
+        exit()
+    ev = ob.read_events(evfile, format='QUAKEML')[0]
+    metadata = ob.read_inventory(invfile)
+
+    def printEvent(event):
+        print(f'{event["station"]} MMI {event["mmi"]} at {event["time"]:.2f}s (compute {event["latency"]*1000.:.2f} ms)')
+
+    engine = initEngine(ev, metadata, printEvent)
+    npackets = 0
+    for packet in replayMS([os.path.join(msdir, ms) for ms in os.listdir(msdir) if not ms.endswith('.part')], speed):
+        processPacket(engine, packet)
+        npackets += 1
+    wrExceedanceTbl(engine, os.path.join(evid, 'exceedance_times_rt.tbl'))
+    with open(os.path.join(evid, 'exceedance_events_rt.txt'), 'w') as fout:
+        for event in engine['events']:
+            fout.write(f'{event["station"]} {event["mmi"]} {event["time"]} {event["latency"]}\n')
+    print(f'Processed {npackets} packets, {len(engine["events"])} station exceedances')
@@ -1,7 +1,9 @@
 #!/bin/bash
 #
-### FinDer source
+### FinDer source, or comma separated sources to compare in one pass (alert tables, plots and
+### metrics are then named by author)
 #fd_auth='scfdrwc'
+#fd_auth='scfinder,scfdrwc'
 fd_auth='scfinder'
 
 alert_method='moratalla_alert_distances.tbl'
@@ -166,7 +168,8 @@ for ((idx = 0; idx < ${#evids[@]}; idx++)); do
       # ms2mmi will: 
       # # download event, inventory and miniseed based on a GeoNet eventID
       # # compute the exceedence times for mmis in range 2.5 -> 8.5 stepping every 0.5 based on miniseed PGA & PGV (median MMI)
-      if [ ! -f ${evid}/exceedance_times.tbl ]; then
+      # # rerun if waveform files were added since (only the new channels are processed)
+      if [ ! -f ${evid}/exceedance_times.tbl ] || [ ${evid}/${evid}_ms -nt ${evid}/exceedance_times.tbl ]; then
         python ms2mmi.py $evid 
       fi
 
@@ -178,20 +181,32 @@ for ((idx = 0; idx < ${#evids[@]}; idx++)); do
 
       # alert_times.py will:
       # # download event based on a GeoNet eventID
-      # # compute alert_distances.tbl ---> mag + mmi -> dist tbl created for GMPE + GMICE (see openquake scripts)
-      if [ ! -f ${evid}/alert_times_${mag_w}_${latency}.tbl ]; then
+      # # compute alert_distances.tbl ---> mag + mmi -> dist tbl created for GMPE + GMICE (see openquake scripts, or alert_dists.py)
+      atag=''
+      if [[ "$fd_auth" == *,* ]]; then
+        atag="_${fd_auth%%,*}"
+      fi
+      # # rerun if the FinDer dump changed since (only new solutions are evaluated)
+      if [ ! -f ${evid}/alert_times_${mag_w}_${latency}${atag}.tbl ] || [ ${evid}/${fd_evid}.xml -nt ${evid}/alert_times_${mag_w}_${latency}${atag}.tbl ]; then
         echo 'Calculating alert table'
         python alert_times.py $evid $fd_evid $fd_auth $alert_method $mag_w $latency
       fi
 
+      # metrics.py will:
+      # # compute category counts and warning time quantiles as continuous functions of latency
+      # # from the zero latency alert table (no rerun needed per latency)
+      if [ "$latency" == "0" ]; then
+        python metrics.py $evid $mmi_tw $mag_w 30 - - $fd_auth
+      fi
+
       # Plotting
       if true; then
-        python plots.py $evid $mmi_tw $mag_w $latency $fd_evid
+        python plots.py $evid $mmi_tw $mag_w $latency $fd_evid $fd_auth
         plotdir="plots_latency-${latency}_mag-${mag_w}_mmitw-${mmi_tw}"
         if [ ! -d ${evid}/${plotdir} ]; then
           mkdir ${evid}/${plotdir}
         fi
-        mv ${evid}/${evid}_mmi*.png ${evid}/*_mmi*.dat ${evid}/${plotdir}
+        mv ${evid}/${evid}_*mmi*.png ${evid}/*_mmi*.dat ${evid}/${plotdir}
       fi
     done
   done
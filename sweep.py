@@ -0,0 +1,125 @@
+import os, sys
+from numpy import arange, around, where, inf, nan, array, full, bincount, savez, load, \
+        maximum
+
+import alert_times as at
+import plots
+
+def rdAlertIndex(fname):
+    '''
+    Read the alert index written by the sweep (alert_times.computeAlertIndex)
+    '''
+    data = load(fname)
+    return {k: data[k] for k in data.files}
+
+def alertIndex(evid, fd_evid, author, adistfile):
+    '''
+    Alert index of a FinDer author (alert_index_<author>.npz), rebuilt if it is missing or was built
+    from other sites, solutions or alert distances (alert_times.indexKey)
+    '''
+    import obspy as ob
+    ifname = os.path.join(evid, f'alert_index_{author}.npz')
+    alerts = at.rdAlerts(os.path.join(evid, f'{fd_evid}.xml'), author, -inf, 0.)
+    sites = at.rdSites(os.path.join(evid, f'{evid}_inventory.xml'))
+    adists = at.rdAlertDists(adistfile)
+    key = at.indexKey(sites, alerts, adists)
+    if os.path.isfile(ifname):
+        index = rdAlertIndex(ifname)
+        if 'key' in index and str(index['key']) == key:
+            return index
+        print(f'Rebuilding {ifname} for changed sites, solutions or alert distances')
+    ev = ob.read_events(os.path.join(evid, f'{evid}.xml'), format='QUAKEML')[0]
+    index = at.computeAlertIndex(ev, sites, alerts, adists)
+    index['key'] = array(key)
+    savez(ifname, **index)
+    return index
+
+def cumulativeMags(index):
+    '''
+    For each site, alert MMI and solution, the largest magnitude of the solutions up to and
+    including this one that alert the site at this MMI (-inf if none). Along the solution axis
+    this is non-decreasing, so the first alert for a threshold mag_w is the first solution where
+    it reaches mag_w.
+    Returns:
+        array (site, MMI, solution)
+    '''
+    trig = index['adist'][None, :, :] > index['dist'][:, :, None] # site, solution, MMI
+    mags = where(trig, index['mags'][None, :, None], -inf)
+    return maximum.accumulate(mags, axis=1).transpose(0, 2, 1)
+
+def firstAlertTimes(index, cummags, mag_w, latency=0.):
+    '''
+    First alert time for each site and alert MMI for a magnitude threshold (NaN if not alerted)
+    '''
+    nsol = len(index['times'])
+    first = (cummags < mag_w).sum(axis=2)
+    times = full(first.shape, nan)
+    alerted = first < nsol
+    times[alerted] = index['times'][first[alerted]] + latency
+    return times
+
+def magSweep(index, obs, mmi_tw, mags, latency=0.):
+    '''
+    Category counts against magnitude threshold, from a single alert index
+    Returns:
+        counts: dictionary by alert MMI of arrays (threshold, category) of station counts
+    '''
+    cummags = cumulativeMags(index)
+    names = {s: i for i, s in enumerate(index['names'])}
+    stns = [s for s in obs if s in names]
+    ind = array([names[s] for s in stns], dtype=int)
+    obs_tw = array([nan if obs[s][mmi_tw] is None else obs[s][mmi_tw] for s in stns])
+    counts = {}
+    for k, mmi_a in enumerate(index['mmis']):
+        mmi_a = float(mmi_a)
+        if mmi_a not in obs[stns[0]]:
+            continue
+        obs_a = array([nan if obs[s][mmi_a] is None else obs[s][mmi_a] for s in stns])
+        counts[mmi_a] = full((len(mags), len(plots.CATEGORIES)), 0)
+        for i, mag_w in enumerate(mags):
+            alert_a = firstAlertTimes(index, cummags[:, k:k+1, :], mag_w, latency)[ind, 0]
+            counts[mmi_a][i] = bincount(plots.categoriseArrays(obs_a, obs_tw, alert_a), minlength=len(plots.CATEGORIES))
+    return counts
+
+def wrMagSweep(fname, mags, counts):
+    '''
+    Write the sweep: magnitude threshold then counts for each alert MMI and category
+    '''
+    with open(fname, 'w') as fout:
+        fout.write('# mag_w ' + ' '.join([f'{c}_mmi{mmi_a}' for mmi_a in counts for c in plots.CATEGORIES]) + '\n')
+        for i, mag_w in enumerate(mags):
+            fout.write(f'{mag_w:.1f} ' + ' '.join([' '.join([str(n) for n in counts[mmi_a][i]]) for mmi_a in counts]) + '\n')
+    return
+
+if __name__ == '__main__':
+    ###
+    ### Input parameters ###
+    ###
+    evid = sys.argv[1] # GeoNet event ID
+    fd_evid = sys.argv[2] # FinDer event ID
+    author = sys.argv[3] # FinDer pipeline author
+    adistfile = sys.argv[4] # Alert distance file, or GMICE name
+    mmi_tw = float(sys.argv[5]) # Target MMI to provide warning for, onset of damage
+    latency = float(sys.argv[6]) if len(sys.argv) > 6 else 0. # Added latency for alerts
+    magmin = float(sys.argv[7]) if len(sys.argv) > 7 else 4.0 # Magnitude threshold range
+    magmax = float(sys.argv[8]) if len(sys.argv) > 8 else 7.0
+    magstep = float(sys.argv[9]) if len(sys.argv) > 9 else 0.1
+    ###
+    ### Input parameters ###
+    ###
+
+    ofname = os.path.join(evid, 'exceedance_times.tbl')
+    if not os.path.isfile(ofname):
+        print(f'Cannot sweep magnitude thresholds as file {ofname} is missing')
+        exit()
+    alertfile = os.path.join(evid, f'{fd_evid}.xml')
+    if not os.path.isfile(alertfile):
+        print(f'Error missing FinDer event with id {fd_evid}')
+        exit()
+    index = alertIndex(evid, fd_evid, author, adistfile)
+    obs = plots.rdExceedanceTbl(ofname)
+
+    mags = around(arange(magmin, magmax + magstep/2., magstep), 1)
+    counts = magSweep(index, obs, mmi_tw, mags, latency)
+    wrMagSweep(os.path.join(evid, f'{evid}_magsweep_{latency:.0f}_mmitw-{mmi_tw}.dat'), mags, counts)
+    plots.plotMagSweep(evid, mmi_tw, latency, mags, counts)